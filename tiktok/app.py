@@ -1,22 +1,35 @@
 from __future__ import annotations
 
-import json
+import argparse
 import os
+import threading
+import time
 from dataclasses import dataclass
 from datetime import datetime, timezone
+from functools import lru_cache
 from pathlib import Path
-from typing import Any
+from typing import Any, Callable
 
-from flask import Flask, jsonify, render_template, request
+from flask import Flask, Response, jsonify, render_template, request
+from flask.json.provider import JSONProvider
 from werkzeug.utils import secure_filename
 
+import archive
+import jsonenc
+from replica import Comment, Replica, parse_peers, read_vv
+from search import InvertedIndex
+
 
 ROOT = Path(__file__).resolve().parent
 DATA_DIR = ROOT / "data"
 DB_PATH = DATA_DIR / "db.json"
 VIDEOS_DIR = ROOT / "static" / "videos"
+# Comments older than archive.RETENTION_DAYS are moved here as compressed, immutable segments.
+ARCHIVE_DIR = DATA_DIR / "archive" / "web"
 
 ALLOWED_VIDEO_EXTS = {".mp4", ".webm", ".ogg"}
+# Directory mtimes are coarse: a listing taken this soon after the last change may have missed a file.
+RACY_SCAN_NS = 2_000_000_000
 
 
 def _utc_iso() -> str:
@@ -26,15 +39,21 @@ def _utc_iso() -> str:
 def _atomic_write_json(path: Path, payload: dict[str, Any]) -> None:
     path.parent.mkdir(parents=True, exist_ok=True)
     tmp = path.with_suffix(path.suffix + ".tmp")
-    tmp.write_text(json.dumps(payload, ensure_ascii=False, indent=2) + "\n", encoding="utf-8")
+    tmp.write_bytes(jsonenc.dumpb(payload) + b"\n")
     os.replace(tmp, path)
 
 
+# Serialises read-modify-write of db.json between request threads and the compaction job.
+_DB_LOCK = threading.Lock()
+# Called by compact_db with the ids of videos that lost comments to the archive (create_app re-indexes them).
+_compaction_listeners: list[Callable[[set[str]], None]] = []
+
+
 def _load_db() -> dict[str, Any]:
     if not DB_PATH.exists():
         return {"likes": {}, "comments": {}}
     try:
-        data = json.loads(DB_PATH.read_text(encoding="utf-8"))
+        data = jsonenc.loads(DB_PATH.read_bytes())
         if not isinstance(data, dict):
             return {"likes": {}, "comments": {}}
         data.setdefault("likes", {})
@@ -44,6 +63,92 @@ def _load_db() -> dict[str, Any]:
         return {"likes": {}, "comments": {}}
 
 
+# (mtime_ns, size, inode) of db.json -> its parsed contents. Writers always replace the file, so the inode changes.
+_db_cache: tuple[tuple[int, int, int], dict[str, Any]] | None = None
+
+
+def _read_db() -> dict[str, Any]:
+    """db.json for read-only use, parsed again only when the file has changed. Don't mutate the result."""
+    global _db_cache
+    try:
+        st = DB_PATH.stat()
+    except OSError:
+        return {"likes": {}, "comments": {}}
+    stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+    cached = _db_cache
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    db = _load_db()
+    _db_cache = (stamp, db)
+    return db
+
+
+def _archived_count(db: dict[str, Any], video_id: str) -> int:
+    return int((db.get("archive") or {}).get("comments", {}).get(video_id, 0) or 0)
+
+
+def compact_db(*, days: int = archive.RETENTION_DAYS, keep_recent: int = archive.KEEP_RECENT_COMMENTS) -> int:
+    """Move comments older than `days` (except the newest `keep_recent` per video) into an archive segment.
+
+    db.json keeps a per-video count of archived comments, so commentsCount stays exact.
+    """
+    cutoff = archive.cutoff_iso(days)
+    with _DB_LOCK:
+        db = _load_db()
+        moved: list[dict[str, Any]] = []
+        for video_id, comments in db["comments"].items():
+            comments = comments or []
+            split = max(0, len(comments) - keep_recent)
+            old = [c for c in comments[:split] if str(c.get("ts") or "") < cutoff]
+            if not old:
+                continue
+            db["comments"][video_id] = [c for c in comments[:split] if str(c.get("ts") or "") >= cutoff] + comments[split:]
+            moved.extend({"video_id": video_id, **c} for c in old)
+        if not moved:
+            return 0
+        segment = archive.write_segment(ARCHIVE_DIR, f"comments-{datetime.now(timezone.utc):%Y%m%dT%H%M%S%f}", moved)
+        meta = db.setdefault("archive", {})
+        counts = meta.setdefault("comments", {})
+        for row in moved:
+            counts[row["video_id"]] = int(counts.get(row["video_id"], 0) or 0) + 1
+        meta.setdefault("segments", []).append(segment.name)
+        _atomic_write_json(DB_PATH, db)
+    video_ids = {row["video_id"] for row in moved}
+    for listener in _compaction_listeners:
+        listener(video_ids)
+    return len(moved)
+
+
+def archived_comments(video_id: str) -> list[dict[str, Any]]:
+    """Slow path: archived comments of a video, oldest first."""
+    out = []
+    for name in (_load_db().get("archive") or {}).get("segments", []):
+        out.extend(
+            {"text": r.get("text", ""), "ts": r.get("ts", "")}
+            for r in archive.read_segment(ARCHIVE_DIR / name)
+            if r.get("video_id") == video_id
+        )
+    return out
+
+
+def search_archived(query: str) -> list[dict[str, Any]]:
+    """Slow path: archived comments containing every word of `query` (the search index only has hot ones)."""
+    words = query.casefold().split()
+    out = []
+    for name in (_load_db().get("archive") or {}).get("segments", []):
+        out.extend(r for r in archive.read_segment(ARCHIVE_DIR / name) if archive.matches(r.get("text", ""), words))
+    return out
+
+
+def _run_compaction_forever() -> None:
+    while True:
+        try:
+            compact_db()
+        except Exception as e:
+            print(f"compaction failed: {e!r}")
+        threading.Event().wait(archive.INTERVAL_S)
+
+
 @dataclass(frozen=True)
 class VideoItem:
     video_id: str
@@ -65,18 +170,184 @@ class VideoItem:
         return "@" + (normalized[:18] or "tiktuk_py")
 
 
-def _scan_videos() -> list[VideoItem]:
+def _scan_videos(known: dict[str, VideoItem] | None = None) -> list[VideoItem]:
     VIDEOS_DIR.mkdir(parents=True, exist_ok=True)
-    files = []
-    for p in sorted(VIDEOS_DIR.iterdir(), key=lambda x: x.name.lower()):
-        if p.is_file() and p.suffix.lower() in ALLOWED_VIDEO_EXTS:
-            files.append(VideoItem(video_id=p.name, filename=p.name))
-    return files
+    # scandir's entries know their type without a stat() per file.
+    with os.scandir(VIDEOS_DIR) as it:
+        names = [e.name for e in it if e.name[e.name.rfind(".") :].lower() in ALLOWED_VIDEO_EXTS and e.is_file()]
+    names.sort(key=str.lower)
+    known = known or {}
+    return [known.get(name) or VideoItem(video_id=name, filename=name) for name in names]
+
+
+@dataclass(frozen=True)
+class Library:
+    videos: list[VideoItem]
+    by_id: dict[str, VideoItem]
 
 
-def create_app() -> Flask:
+# (directory mtime_ns, listing, rescan-once deadline or 0)
+_library_cache: tuple[int, Library, int] | None = None
+_library_lock = threading.Lock()
+
+
+def _library() -> Library:
+    """The video directory listing, rescanned only when the directory's mtime changes."""
+    global _library_cache
+    VIDEOS_DIR.mkdir(parents=True, exist_ok=True)
+    mtime = VIDEOS_DIR.stat().st_mtime_ns
+    cached = _library_cache
+    if cached is not None and cached[0] == mtime and (not cached[2] or time.time_ns() < cached[2]):
+        return cached[1]
+    with _library_lock:
+        cached = _library_cache
+        now = time.time_ns()
+        if cached is not None and cached[0] == mtime and (not cached[2] or now < cached[2]):
+            return cached[1]
+        videos = _scan_videos(cached[1].by_id if cached is not None else None)
+        library = Library(videos, {v.video_id: v for v in videos})
+        # A file added in the same mtime tick as this scan wouldn't bump the stamp: when the directory changed
+        # moments ago, scan once more after the window has passed.
+        recheck = mtime + RACY_SCAN_NS if now - mtime < RACY_SCAN_NS else 0
+        _library_cache = (mtime, library, recheck)
+        return library
+
+
+def _invalidate_library() -> None:
+    global _library_cache
+    _library_cache = None
+
+
+def _upload_target(filename: str) -> Path:
+    """Pick where an uploaded file lands: its own name, or a timestamped one if that is taken."""
+    VIDEOS_DIR.mkdir(parents=True, exist_ok=True)
+    target = VIDEOS_DIR / filename
+    if not target.exists():
+        return target
+    stem, ext = Path(filename).stem, Path(filename).suffix.lower()
+    target = VIDEOS_DIR / f"{stem}-{int(datetime.now().timestamp())}{ext}"
+    n = 1
+    while target.exists():
+        # Bulk imports can hit the same second many times over.
+        target = VIDEOS_DIR / f"{stem}-{int(datetime.now().timestamp())}-{n}{ext}"
+        n += 1
+    return target
+
+
+@lru_cache(maxsize=65536)
+def _feed_head(v: VideoItem) -> bytes:
+    # Everything but the counters depends only on the file name, so it is encoded once per video.
+    fixed = jsonenc.dumpb({"id": v.video_id, "url": v.url, "caption": v.caption, "author": v.author})
+    return fixed[:-1] + b',"likes":'
+
+
+def _encode_feed_item(v: VideoItem, db: dict[str, Any], replica: Replica | None = None) -> bytes:
+    """{"id", "url", "caption", "author", "likes", "commentsCount"} as JSON, from the cached fixed part."""
+    if replica is not None:
+        likes, count = replica.value(v.video_id) or 0, replica.comment_count(v.video_id)
+    else:
+        likes = int(db.get("likes", {}).get(v.video_id, 0) or 0)
+        count = len(db.get("comments", {}).get(v.video_id, []) or [])
+    count += _archived_count(db, v.video_id)
+    return _feed_head(v) + b"%d,\"commentsCount\":%d}" % (likes, count)
+
+
+def _json_items(items: list[bytes], **extra: Any) -> Response:
+    body = b'{"items":[' + b",".join(items) + b"]"
+    if extra:
+        body += b"," + jsonenc.dumpb(extra)[1:]
+    else:
+        body += b"}"
+    return Response(body, mimetype="application/json")
+
+
+def _comments(video_id: str, db: dict[str, Any], replica: Replica | None = None) -> list[dict[str, Any]]:
+    if replica is not None:
+        return replica.comments(video_id)
+    return db.get("comments", {}).get(video_id, []) or []
+
+
+def _sync_search(
+    index: InvertedIndex,
+    old: Library | None,
+    new: Library,
+    db: dict[str, Any],
+    replica: Replica | None = None,
+) -> None:
+    """Move the index from one directory listing to the next: drop videos that are gone, index new ones."""
+    old_ids = old.by_id.keys() if old is not None else set()
+    for video_id in old_ids - new.by_id.keys():
+        index.remove(video_id)
+    for video_id in new.by_id.keys() - old_ids:
+        _index_video(index, new.by_id[video_id], db, replica)
+
+
+def _index_video(index: InvertedIndex, v: VideoItem, db: dict[str, Any], replica: Replica | None = None) -> None:
+    comments = _comments(v.video_id, db, replica)
+    index.replace(v.video_id, [v.caption, *(str(c.get("text") or "") for c in comments)])
+
+
+class _JSONProvider(JSONProvider):
+    """Routes jsonify and request.get_json through jsonenc."""
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return jsonenc.dumps(obj)
+
+    def loads(self, s: str | bytes, **kwargs: Any) -> Any:
+        return jsonenc.loads(s)
+
+
+def seed_replica(replica: Replica) -> None:
+    """Copy this node's db.json likes and comments into a freshly created replica as its own operations."""
+    db = _load_db()
+    for video_id, likes in db["likes"].items():
+        replica.add(video_id, int(likes or 0))
+    for video_id, comments in db["comments"].items():
+        for c in comments or []:
+            replica.add_comment(video_id, str(c.get("text") or ""), str(c.get("ts") or ""))
+
+
+def create_app(replica: Replica | None = None) -> Flask:
+    """With `replica`, likes and comments live in the replicated state instead of db.json."""
     app = Flask(__name__)
+    app.json = _JSONProvider(app)
     app.config["MAX_CONTENT_LENGTH"] = 250 * 1024 * 1024  # 250MB
+    search_index = InvertedIndex()
+    search_lock = threading.Lock()
+    indexed: Library | None = None
+
+    def indexed_library() -> Library:
+        # The index follows the directory listing; it is only touched when the listing changes.
+        nonlocal indexed
+        library = _library()
+        if library is not indexed:
+            with search_lock:
+                if library is not indexed:
+                    _sync_search(search_index, indexed, library, _read_db(), replica)
+                    indexed = library
+        return library
+
+    if replica is not None:
+
+        def index_remote(comments: list[Comment]) -> None:
+            for c in comments:
+                if c.video_id in search_index:
+                    search_index.add(c.video_id, c.text)
+
+        replica.on_comments = index_remote
+
+    def reindex_compacted(video_ids: set[str]) -> None:
+        # Archived comments leave the search index too: rebuild these videos from caption + hot comments.
+        with search_lock:
+            if indexed is None:
+                return
+            db = _read_db()
+            for video_id in video_ids:
+                v = indexed.by_id.get(video_id)
+                if v is not None and video_id in search_index:
+                    _index_video(search_index, v, db, replica)
+
+    _compaction_listeners.append(reindex_compacted)
 
     @app.get("/")
     def index():
@@ -84,35 +355,41 @@ def create_app() -> Flask:
 
     @app.get("/api/feed")
     def feed():
-        db = _load_db()
-        items = []
-        for v in _scan_videos():
-            likes = int(db.get("likes", {}).get(v.video_id, 0) or 0)
-            comments = db.get("comments", {}).get(v.video_id, []) or []
-            items.append(
-                {
-                    "id": v.video_id,
-                    "url": v.url,
-                    "caption": v.caption,
-                    "author": v.author,
-                    "likes": likes,
-                    "commentsCount": len(comments),
-                }
-            )
-        return jsonify({"items": items})
+        db = _read_db()
+        return _json_items([_encode_feed_item(v, db, replica) for v in _library().videos])
+
+    @app.get("/api/search")
+    def search():
+        try:
+            limit = max(1, min(100, int(request.args.get("limit", 20))))
+            offset = max(0, int(request.args.get("offset", 0)))
+        except ValueError:
+            return jsonify({"error": "Некорректные limit/offset"}), 400
+        library = indexed_library()
+        total, ids = search_index.search(request.args.get("q", ""), limit=limit, offset=offset)
+        if not ids:
+            return _json_items([], total=total)
+        # Counts are only looked up for the page being returned.
+        db = _read_db()
+        by_id = library.by_id
+        return _json_items([_encode_feed_item(by_id[i], db, replica) for i in ids if i in by_id], total=total)
 
     @app.post("/api/videos/<video_id>/like")
     def like(video_id: str):
-        db = _load_db()
-        db.setdefault("likes", {})
-        db["likes"][video_id] = int(db["likes"].get(video_id, 0) or 0) + 1
-        _atomic_write_json(DB_PATH, db)
+        if replica is not None:
+            return jsonify({"id": video_id, "likes": replica.add(video_id, 1)})
+        with _DB_LOCK:
+            db = _load_db()
+            db.setdefault("likes", {})
+            db["likes"][video_id] = int(db["likes"].get(video_id, 0) or 0) + 1
+            _atomic_write_json(DB_PATH, db)
         return jsonify({"id": video_id, "likes": db["likes"][video_id]})
 
     @app.get("/api/videos/<video_id>/comments")
     def get_comments(video_id: str):
-        db = _load_db()
-        comments = db.get("comments", {}).get(video_id, []) or []
+        comments = _comments(video_id, _read_db(), replica)
+        if request.args.get("archived") == "1":
+            comments = archived_comments(video_id) + comments
         return jsonify({"id": video_id, "comments": comments})
 
     @app.post("/api/videos/<video_id>/comment")
@@ -122,11 +399,17 @@ def create_app() -> Flask:
         if not text:
             return jsonify({"error": "Комментарий пустой"}), 400
 
-        db = _load_db()
-        db.setdefault("comments", {})
-        db["comments"].setdefault(video_id, [])
-        db["comments"][video_id].append({"text": text[:280], "ts": _utc_iso()})
-        _atomic_write_json(DB_PATH, db)
+        if replica is not None:
+            replica.add_comment(video_id, text[:280], _utc_iso())
+        else:
+            with _DB_LOCK:
+                db = _load_db()
+                db.setdefault("comments", {})
+                db["comments"].setdefault(video_id, [])
+                db["comments"][video_id].append({"text": text[:280], "ts": _utc_iso()})
+                _atomic_write_json(DB_PATH, db)
+        if video_id in search_index:
+            search_index.add(video_id, text[:280])
         return jsonify({"ok": True})
 
     @app.post("/api/upload")
@@ -140,17 +423,49 @@ def create_app() -> Flask:
         if ext not in ALLOWED_VIDEO_EXTS:
             return jsonify({"error": f"Разрешены только: {', '.join(sorted(ALLOWED_VIDEO_EXTS))}"}), 400
 
-        VIDEOS_DIR.mkdir(parents=True, exist_ok=True)
-        target = VIDEOS_DIR / filename
-        if target.exists():
-            target = VIDEOS_DIR / f"{Path(filename).stem}-{int(datetime.now().timestamp())}{ext}"
+        target = _upload_target(filename)
         f.save(target)
+        _invalidate_library()
         return jsonify({"ok": True, "filename": target.name})
 
+    @app.post("/api/replica/sync")
+    def replica_sync():
+        if replica is None:
+            return jsonify({"error": "Репликация выключена"}), 404
+        try:
+            vv = read_vv(request.get_json(silent=True))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        return jsonify(replica.delta_for(vv))
+
     return app
 
 
 if __name__ == "__main__":
-    app = create_app()
-    app.run(host="127.0.0.1", port=5050, debug=True)
+    parser = argparse.ArgumentParser(description="TikTuk web app")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5050)
+    parser.add_argument("--data", type=Path, default=DATA_DIR, help="state directory (db.json, archive, replica files)")
+    parser.add_argument("--node", help="replication node id; keeps likes/comments in <data>/replica-<node>.json")
+    parser.add_argument("--peers", default="", help="comma-separated base URLs of the other nodes")
+    args = parser.parse_args()
+    DATA_DIR = args.data.resolve()
+    DB_PATH = DATA_DIR / DB_PATH.name
+    ARCHIVE_DIR = DATA_DIR / "archive" / "web"
+
+    if args.node is None:
+        if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+            # Only in the reloader's serving child, so there's a single compactor.
+            threading.Thread(target=_run_compaction_forever, name="compaction", daemon=True).start()
+        create_app().run(host=args.host, port=args.port, debug=True)
+    else:
+        replica = Replica(args.node, DATA_DIR / f"replica-{args.node}.json", parse_peers(args.peers))
+        if replica.created:
+            seed_replica(replica)
+        replica.start()
+        try:
+            # No reloader: it would run a second process with its own copy of the replica.
+            create_app(replica).run(host=args.host, port=args.port, debug=True, use_reloader=False)
+        finally:
+            replica.close()
 
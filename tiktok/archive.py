@@ -0,0 +1,224 @@
+from __future__ import annotations
+
+import argparse
+import gzip
+import os
+import sqlite3
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Callable, Iterable, Iterator
+
+import jsonenc
+
+
+RETENTION_DAYS = 90
+# Newest comments per video that always stay hot, so "last comments" never needs the archive.
+KEEP_RECENT_COMMENTS = 10
+BATCH_ROWS = 2000
+INTERVAL_S = 6 * 60 * 60
+
+
+def cutoff_iso(days: int) -> str:
+    return (datetime.now(timezone.utc) - timedelta(days=days)).isoformat(timespec="seconds")
+
+
+def write_segment(directory: Path, name: str, rows: Iterable[dict[str, Any]]) -> Path:
+    """Write rows as a gzip'd JSONL segment. Segments are written once (tmp + fsync + rename) and then read-only."""
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f"{name}.jsonl.gz"
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "wb") as raw:
+        with gzip.GzipFile(fileobj=raw, mode="wb", mtime=0) as gz:
+            gz.write(b"".join(jsonenc.dumpb(row) + b"\n" for row in rows))
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.chmod(tmp, 0o444)
+    os.replace(tmp, path)
+    return path
+
+
+def read_segment(path: Path) -> Iterator[dict[str, Any]]:
+    with gzip.open(path, "rb") as fh:
+        for line in fh:
+            if line.strip():
+                yield jsonenc.loads(line)
+
+
+# -- bot (SQLite) ------------------------------------------------------------------------------------
+
+
+def _keep_from(conn: sqlite3.Connection, video_id: int, keep_recent: int) -> float:
+    """Lowest comment id among the video's newest `keep_recent`; comments from there on stay hot."""
+    if keep_recent <= 0:
+        return float("inf")
+    row = conn.execute(
+        "SELECT id FROM comments WHERE video_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?",
+        (video_id, keep_recent - 1),
+    ).fetchone()
+    return row[0] if row else 0
+
+
+def _old_comment_batches(conn: sqlite3.Connection, cutoff: str, keep_recent: int) -> Iterator[list[tuple[Any, ...]]]:
+    """Comments to archive, in batches. Pages through the table by id, so each row is looked at once."""
+    keep_from: dict[int, float] = {}
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            "SELECT id, video_id, user_id, text, ts FROM comments WHERE id > ? AND ts < ? ORDER BY id LIMIT ?",
+            (last_id, cutoff, BATCH_ROWS),
+        ).fetchall()
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        # Ranking per video once (via comments_by_video) instead of a window over the whole table per batch.
+        # A cached bound can only be too low as new comments arrive, which keeps more rows hot, never fewer.
+        for video_id in {r[1] for r in rows} - keep_from.keys():
+            keep_from[video_id] = _keep_from(conn, video_id, keep_recent)
+        old = [r for r in rows if r[0] < keep_from[r[1]]]
+        if old:
+            yield old
+
+
+def _archive_bot_comments(conn: sqlite3.Connection, directory: Path, rows: list[tuple[Any, ...]]) -> int:
+    name = f"comments-{rows[0][0]:012d}-{rows[-1][0]:012d}"
+    path = write_segment(
+        directory,
+        name,
+        ({"id": r[0], "video_id": r[1], "user_id": r[2], "text": r[3], "ts": r[4]} for r in rows),
+    )
+    # The segment is only visible once this transaction registers it; a crash before that leaves an
+    # orphan file that the next run overwrites under the same name. Deleting the comments also drops
+    # their search_fts rows (trigger), so archived text leaves the hot database entirely.
+    with conn:
+        conn.executemany("DELETE FROM comments WHERE id = ?", [(r[0],) for r in rows])
+        conn.executemany(
+            """
+            INSERT INTO archived_counts (video_id, comments) VALUES (?, ?)
+            ON CONFLICT(video_id) DO UPDATE SET comments = comments + excluded.comments
+            """,
+            Counter(r[1] for r in rows).items(),
+        )
+        conn.execute(
+            "INSERT INTO archive_segments (kind, path, rows, min_ts, max_ts) VALUES ('comments', ?, ?, ?, ?)",
+            (path.name, len(rows), min(r[4] for r in rows), max(r[4] for r in rows)),
+        )
+    return len(rows)
+
+
+def _archive_bot_likes(conn: sqlite3.Connection, directory: Path, cutoff: str) -> int:
+    rows = conn.execute(
+        "SELECT rowid, video_id, user_id, liked_at FROM likes WHERE liked_at < ? ORDER BY rowid LIMIT ?",
+        (cutoff, BATCH_ROWS),
+    ).fetchall()
+    if not rows:
+        return 0
+    name = f"likes-{rows[0][0]:012d}-{rows[-1][0]:012d}-{datetime.now(timezone.utc):%Y%m%dT%H%M%S}"
+    path = write_segment(directory, name, ({"video_id": r[1], "user_id": r[2], "liked_at": r[3]} for r in rows))
+    with conn:
+        conn.executemany("DELETE FROM likes WHERE video_id = ? AND user_id = ?", [(r[1], r[2]) for r in rows])
+        # Keep who liked what (without timestamps) so like_once still refuses a second like.
+        conn.executemany(
+            "INSERT OR IGNORE INTO archived_likes (video_id, user_id) VALUES (?, ?)",
+            [(r[1], r[2]) for r in rows],
+        )
+        conn.executemany(
+            """
+            INSERT INTO archived_counts (video_id, likes) VALUES (?, ?)
+            ON CONFLICT(video_id) DO UPDATE SET likes = likes + excluded.likes
+            """,
+            Counter(r[1] for r in rows).items(),
+        )
+        conn.execute(
+            "INSERT INTO archive_segments (kind, path, rows, min_ts, max_ts) VALUES ('likes', ?, ?, ?, ?)",
+            (path.name, len(rows), min(r[3] for r in rows), max(r[3] for r in rows)),
+        )
+    return len(rows)
+
+
+def compact_bot_db(
+    open_db: Callable[[], sqlite3.Connection],
+    directory: Path,
+    *,
+    days: int = RETENTION_DAYS,
+    keep_recent: int = KEEP_RECENT_COMMENTS,
+) -> tuple[int, int]:
+    """Move comments and likes older than `days` into archive segments. Returns (comments, likes) moved.
+
+    Works in small batches so the write lock is only held briefly.
+    """
+    cutoff = cutoff_iso(days)
+    moved_comments = moved_likes = 0
+    conn = open_db()
+    try:
+        for batch in _old_comment_batches(conn, cutoff, keep_recent):
+            moved_comments += _archive_bot_comments(conn, directory, batch)
+        while n := _archive_bot_likes(conn, directory, cutoff):
+            moved_likes += n
+    finally:
+        conn.close()
+    return moved_comments, moved_likes
+
+
+def bot_archived_comments(conn: sqlite3.Connection, directory: Path, video_id: int) -> list[dict[str, Any]]:
+    """Slow path: every archived comment of a video, oldest first."""
+    out: list[dict[str, Any]] = []
+    for (name,) in conn.execute("SELECT path FROM archive_segments WHERE kind = 'comments' ORDER BY id"):
+        out.extend(r for r in read_segment(directory / name) if r.get("video_id") == video_id)
+    return out
+
+
+def matches(text: str, words: list[str]) -> bool:
+    """Every query word appears in the text (case-insensitive)."""
+    folded = (text or "").casefold()
+    return all(w in folded for w in words)
+
+
+def bot_search_archived(conn: sqlite3.Connection, directory: Path, query: str) -> list[dict[str, Any]]:
+    """Slow path: archived comments containing every word of `query`. Hot search (search_fts) doesn't cover them."""
+    words = query.casefold().split()
+    out: list[dict[str, Any]] = []
+    for (name,) in conn.execute("SELECT path FROM archive_segments WHERE kind = 'comments' ORDER BY id"):
+        out.extend(r for r in read_segment(directory / name) if matches(r.get("text", ""), words))
+    return out
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Move old comments/likes into compressed archive segments.")
+    parser.add_argument("target", choices=["bot", "web"])
+    parser.add_argument("--days", type=int, default=RETENTION_DAYS, help="keep this many days hot")
+    parser.add_argument("--history", metavar="VIDEO_ID", help="print archived comments of one video instead")
+    parser.add_argument("--search", metavar="TEXT", help="print archived comments containing these words instead")
+    args = parser.parse_args()
+    if args.target == "bot":
+        from bot import ARCHIVE_DIR, init_db, open_db
+
+        init_db()
+        if args.history is not None:
+            with open_db() as conn:
+                for row in bot_archived_comments(conn, ARCHIVE_DIR, int(args.history)):
+                    print(f"{row['ts']}  {row['user_id']}: {row['text']}")
+            return
+        if args.search is not None:
+            with open_db() as conn:
+                for row in bot_search_archived(conn, ARCHIVE_DIR, args.search):
+                    print(f"{row['ts']}  video {row['video_id']}  {row['user_id']}: {row['text']}")
+            return
+        comments, likes = compact_bot_db(open_db, ARCHIVE_DIR, days=args.days)
+        print(f"bot: archived {comments} comments, {likes} likes")
+    else:
+        from app import archived_comments, compact_db, search_archived
+
+        if args.history is not None:
+            for row in archived_comments(args.history):
+                print(f"{row['ts']}  {row['text']}")
+            return
+        if args.search is not None:
+            for row in search_archived(args.search):
+                print(f"{row['ts']}  {row['video_id']}: {row['text']}")
+            return
+        print(f"web: archived {compact_db(days=args.days)} comments")
+
+
+if __name__ == "__main__":
+    main()
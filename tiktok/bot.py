@@ -2,7 +2,10 @@ from __future__ import annotations
 
 import logging
 import os
+import re
 import sqlite3
+import threading
+import time
 from dataclasses import dataclass
 from datetime import datetime, timezone
 from pathlib import Path
@@ -26,10 +29,24 @@ from telegram.ext import (
     filters,
 )
 
+import archive
+from navstate import NavState
+from shuffle import shuffled_position
+
 
 ROOT = Path(__file__).resolve().parent
 DATA_DIR = ROOT / "data"
 DB_PATH = DATA_DIR / "bot_db.sqlite3"
+# Hot per-user cursor state lives in its own file so nav taps don't contend with content writes.
+NAV_DB_PATH = DATA_DIR / "bot_nav.sqlite3"
+# Compressed, immutable segments of comments/likes older than archive.RETENTION_DAYS.
+ARCHIVE_DIR = DATA_DIR / "archive" / "bot"
+
+SEARCH_PAGE_SIZE = 5
+# Shuffle steps that land on a missing id before giving up for this tap.
+SHUFFLE_MAX_MISSES = 64
+# How long the shuffle's id range (MAX(id)) is reused before asking the database again.
+MAX_ID_TTL_S = 5.0
 
 
 def utc_iso() -> str:
@@ -47,6 +64,18 @@ def open_db() -> sqlite3.Connection:
 
 def init_db() -> None:
     with open_db() as conn:
+        has_search = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'search_fts'").fetchone() is not None
+        if has_search and conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'comments_search_ad'").fetchone() is None:
+            # Index from before comment rows were keyed by comment id: rebuild it in the current layout.
+            conn.executescript(
+                """
+                DROP TRIGGER IF EXISTS videos_search_ai;
+                DROP TRIGGER IF EXISTS comments_search_ai;
+                DROP TRIGGER IF EXISTS videos_search_ad;
+                DROP TABLE search_fts;
+                """
+            )
+            has_search = False
         conn.executescript(
             """
             CREATE TABLE IF NOT EXISTS videos (
@@ -79,8 +108,79 @@ def init_db() -> None:
               idx INTEGER NOT NULL DEFAULT 0,
               pending_comment_video_id INTEGER NULL REFERENCES videos(id) ON DELETE SET NULL
             );
+
+            CREATE INDEX IF NOT EXISTS comments_by_video ON comments (video_id, id);
+
+            -- Cold tier: totals and like membership for rows moved into archive segments.
+            CREATE TABLE IF NOT EXISTS archived_counts (
+              video_id INTEGER PRIMARY KEY REFERENCES videos(id) ON DELETE CASCADE,
+              likes INTEGER NOT NULL DEFAULT 0,
+              comments INTEGER NOT NULL DEFAULT 0
+            );
+
+            CREATE TABLE IF NOT EXISTS archived_likes (
+              video_id INTEGER NOT NULL,
+              user_id INTEGER NOT NULL,
+              PRIMARY KEY (video_id, user_id)
+            ) WITHOUT ROWID;
+
+            CREATE TABLE IF NOT EXISTS archive_segments (
+              id INTEGER PRIMARY KEY AUTOINCREMENT,
+              kind TEXT NOT NULL CHECK(kind IN ('comments','likes')),
+              path TEXT NOT NULL,
+              rows INTEGER NOT NULL,
+              min_ts TEXT NOT NULL,
+              max_ts TEXT NOT NULL
+            );
+
+            -- One row per caption (rowid = -video id) and per hot comment (rowid = comment id); kept in sync by
+            -- the triggers below. Archiving deletes comments, which drops their rows too.
+            CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(
+              body,
+              video_id UNINDEXED,
+              tokenize = 'unicode61 remove_diacritics 2'
+            );
+
+            CREATE TRIGGER IF NOT EXISTS videos_search_ai AFTER INSERT ON videos BEGIN
+              INSERT INTO search_fts (rowid, body, video_id) VALUES (-new.id, new.caption, new.id);
+            END;
+
+            CREATE TRIGGER IF NOT EXISTS comments_search_ai AFTER INSERT ON comments BEGIN
+              INSERT INTO search_fts (rowid, body, video_id) VALUES (new.id, new.text, new.video_id);
+            END;
+
+            CREATE TRIGGER IF NOT EXISTS comments_search_ad AFTER DELETE ON comments BEGIN
+              DELETE FROM search_fts WHERE rowid = old.id;
+            END;
+
+            CREATE TRIGGER IF NOT EXISTS videos_search_ad AFTER DELETE ON videos BEGIN
+              DELETE FROM search_fts WHERE rowid = -old.id;
+            END;
             """
         )
+        if not has_search:
+            # Existing database from before search: index what is already there.
+            conn.execute("INSERT INTO search_fts (rowid, body, video_id) SELECT -id, caption, id FROM videos")
+            conn.execute("INSERT INTO search_fts (rowid, body, video_id) SELECT id, text, video_id FROM comments")
+
+
+def fts_query(text: str) -> str:
+    """Turn free text into an FTS5 query: every word must match, the last one as a prefix."""
+    words = re.findall(r"\w+", text or "")
+    if not words:
+        return ""
+    quoted = ['"' + w.replace('"', '""') + '"' for w in words]
+    quoted[-1] += "*"
+    return " ".join(quoted)
+
+
+def migrate_user_state() -> None:
+    """One-time copy of user_state from the main database into the nav store."""
+    if not nav_state.is_empty():
+        return
+    with open_db() as conn:
+        rows = conn.execute("SELECT user_id, idx, pending_comment_video_id FROM user_state").fetchall()
+    nav_state.import_rows((int(r[0]), int(r[1]), r[2]) for r in rows)
 
 
 @dataclass(frozen=True)
@@ -92,6 +192,10 @@ class Video:
 
 
 class Store:
+    def __init__(self) -> None:
+        self._max_id_value = 0
+        self._max_id_at = float("-inf")
+
     def add_video(
         self,
         *,
@@ -113,16 +217,17 @@ class Store:
                     """,
                     (file_id, file_unique_id, media_type, caption, utc_iso(), added_by),
                 )
+            self._max_id_at = float("-inf")
             return True
         except sqlite3.IntegrityError:
             return False
 
-    def count_videos(self) -> int:
-        with open_db() as conn:
-            (n,) = conn.execute("SELECT COUNT(*) FROM videos").fetchone()
-            return int(n)
+    @staticmethod
+    def _video(row: sqlite3.Row) -> Video:
+        return Video(id=int(row["id"]), file_id=str(row["file_id"]), media_type=str(row["media_type"]), caption=str(row["caption"]))
 
     def get_by_index(self, idx: int) -> Optional[Video]:
+        # OFFSET scan: only used to move users from the old idx-based nav state.
         with open_db() as conn:
             row = conn.execute(
                 """
@@ -133,59 +238,133 @@ class Store:
                 """,
                 (idx,),
             ).fetchone()
-            if not row:
-                return None
-            return Video(id=int(row["id"]), file_id=str(row["file_id"]), media_type=str(row["media_type"]), caption=str(row["caption"]))
+            return self._video(row) if row else None
 
-    def get_user_idx(self, user_id: int) -> int:
+    def get_by_id(self, video_id: int) -> Optional[Video]:
         with open_db() as conn:
-            row = conn.execute("SELECT idx FROM user_state WHERE user_id = ?", (user_id,)).fetchone()
-            if not row:
-                conn.execute("INSERT INTO user_state (user_id, idx) VALUES (?, 0)", (user_id,))
-                return 0
-            return int(row["idx"])
+            row = conn.execute(
+                "SELECT id, file_id, media_type, caption FROM videos WHERE id = ?",
+                (video_id,),
+            ).fetchone()
+            return self._video(row) if row else None
 
-    def set_user_idx(self, user_id: int, idx: int) -> None:
+    def next_video(self, after_id: int) -> Optional[Video]:
         with open_db() as conn:
-            conn.execute(
-                """
-                INSERT INTO user_state (user_id, idx) VALUES (?, ?)
-                ON CONFLICT(user_id) DO UPDATE SET idx = excluded.idx
-                """,
-                (user_id, idx),
-            )
+            row = conn.execute(
+                "SELECT id, file_id, media_type, caption FROM videos WHERE id > ? ORDER BY id LIMIT 1",
+                (after_id,),
+            ).fetchone()
+            return self._video(row) if row else None
 
-    def set_pending_comment(self, user_id: int, video_id: Optional[int]) -> None:
+    def prev_video(self, before_id: int) -> Optional[Video]:
         with open_db() as conn:
-            conn.execute(
+            row = conn.execute(
+                "SELECT id, file_id, media_type, caption FROM videos WHERE id < ? ORDER BY id DESC LIMIT 1",
+                (before_id,),
+            ).fetchone()
+            return self._video(row) if row else None
+
+    def _max_id(self) -> int:
+        # The shuffle domain. Cached briefly: videos also arrive from other processes (ingest.py).
+        now = time.monotonic()
+        if now - self._max_id_at > MAX_ID_TTL_S:
+            with open_db() as conn:
+                (max_id,) = conn.execute("SELECT MAX(id) FROM videos").fetchone()
+            self._max_id_value, self._max_id_at = int(max_id or 0), now
+        return self._max_id_value
+
+    def current_video(self, user_id: int) -> Optional[Video]:
+        """The video the user is on: their saved video, or the nearest one if it is gone; None with no videos."""
+        nav = nav_state.get(user_id)
+        if nav.video_id is not None:
+            video = self.get_by_id(nav.video_id) or self.next_video(nav.video_id) or self.prev_video(nav.video_id)
+        elif nav.idx > 0:
+            video = self.get_by_index(nav.idx) or self.prev_video(self._max_id() + 1)
+        else:
+            video = self.next_video(0)
+        if video is not None and video.id != nav.video_id:
+            self.set_current(user_id, video.id)
+        return video
+
+    def set_current(self, user_id: int, video_id: int) -> None:
+        nav_state.update(user_id, video_id=video_id)
+
+    def next_shuffled(self, user_id: int) -> Optional[Video]:
+        """Next video in the user's own shuffled order.
+
+        Walks a per-user permutation of the id space, so there are no repeats within a cycle and
+        no per-user list to store: the only state is the integer cursor in nav state. Each step is
+        one primary-key lookup.
+        """
+        max_id = self._max_id()
+        if not max_id:
+            return None
+        cursor = nav_state.get(user_id).shuffle_cursor
+        try:
+            for _ in range(SHUFFLE_MAX_MISSES):
+                pos, cursor = shuffled_position(cursor, max_id, user_id)
+                video = self.get_by_id(pos + 1)
+                if video is not None:
+                    return video
+            return None
+        finally:
+            nav_state.update(user_id, shuffle_cursor=cursor)
+
+    def search(self, query: str, *, limit: int, offset: int = 0) -> tuple[int, list[Video]]:
+        match = fts_query(query)
+        if not match:
+            return 0, []
+        with open_db() as conn:
+            (total,) = conn.execute(
+                "SELECT COUNT(DISTINCT video_id) FROM search_fts WHERE search_fts MATCH ?",
+                (match,),
+            ).fetchone()
+            rows = conn.execute(
                 """
-                INSERT INTO user_state (user_id, pending_comment_video_id) VALUES (?, ?)
-                ON CONFLICT(user_id) DO UPDATE SET pending_comment_video_id = excluded.pending_comment_video_id
+                SELECT v.id, v.file_id, v.media_type, v.caption
+                FROM (
+                  SELECT video_id, MIN(rank) AS score
+                  FROM search_fts
+                  WHERE search_fts MATCH ?
+                  GROUP BY video_id
+                ) AS hits
+                JOIN videos v ON v.id = hits.video_id
+                ORDER BY hits.score, v.id
+                LIMIT ? OFFSET ?
                 """,
-                (user_id, video_id),
-            )
+                (match, limit, offset),
+            ).fetchall()
+            return int(total), [self._video(r) for r in rows]
+
+    def set_pending_comment(self, user_id: int, video_id: Optional[int]) -> None:
+        nav_state.update(user_id, pending_comment_video_id=video_id, durable=True)
 
     def get_pending_comment(self, user_id: int) -> Optional[int]:
-        with open_db() as conn:
-            row = conn.execute("SELECT pending_comment_video_id FROM user_state WHERE user_id = ?", (user_id,)).fetchone()
-            if not row:
-                return None
-            return int(row["pending_comment_video_id"]) if row["pending_comment_video_id"] is not None else None
+        return nav_state.get(user_id).pending_comment_video_id
 
     def counts(self, video_id: int) -> tuple[int, int]:
         with open_db() as conn:
             (likes,) = conn.execute("SELECT COUNT(*) FROM likes WHERE video_id = ?", (video_id,)).fetchone()
             (comments,) = conn.execute("SELECT COUNT(*) FROM comments WHERE video_id = ?", (video_id,)).fetchone()
+            row = conn.execute("SELECT likes, comments FROM archived_counts WHERE video_id = ?", (video_id,)).fetchone()
+            if row:
+                likes += row["likes"]
+                comments += row["comments"]
             return int(likes), int(comments)
 
     def like_once(self, *, video_id: int, user_id: int) -> bool:
         try:
             with open_db() as conn:
-                conn.execute(
-                    "INSERT INTO likes (video_id, user_id, liked_at) VALUES (?, ?, ?)",
-                    (video_id, user_id, utc_iso()),
+                # One statement, so compaction can't move an old like between the check and the insert.
+                cur = conn.execute(
+                    """
+                    INSERT INTO likes (video_id, user_id, liked_at)
+                    SELECT ?, ?, ?
+                    WHERE NOT EXISTS (SELECT 1 FROM archived_likes WHERE video_id = ? AND user_id = ?)
+                    """,
+                    (video_id, user_id, utc_iso(), video_id, user_id),
                 )
-            return True
+            return cur.rowcount == 1
         except sqlite3.IntegrityError:
             return False
 
@@ -216,6 +395,7 @@ class Store:
             return [(int(r["user_id"]), str(r["text"]), str(r["ts"])) for r in rows]
 
 
+nav_state = NavState(NAV_DB_PATH)
 store = Store()
 
 
@@ -247,31 +427,21 @@ async def send_or_edit_feed(
     update: Update,
     context: ContextTypes.DEFAULT_TYPE,
     message_to_edit=None,
-    force_idx: Optional[int] = None,
+    video: Optional[Video] = None,
 ) -> None:
     user = update.effective_user
     chat = update.effective_chat
     if not user or not chat:
         return
 
-    total = store.count_videos()
-    if total == 0:
+    if video is None:
+        video = store.current_video(user.id)
+    if video is None:
         await update.effective_message.reply_text(
             "Пока нет видео.\n\nПришли мне видео (или GIF/анимацию) — и я добавлю в ленту.",
         )
         return
-
-    idx = force_idx if force_idx is not None else store.get_user_idx(user.id)
-    idx = max(0, min(total - 1, idx))
-    store.set_user_idx(user.id, idx)
-
-    video = store.get_by_index(idx)
-    if not video:
-        store.set_user_idx(user.id, 0)
-        video = store.get_by_index(0)
-        if not video:
-            await update.effective_message.reply_text("Лента сломалась (нет видео). Пришли мне видео.")
-            return
+    store.set_current(user.id, video.id)
 
     caption = render_caption(video)
     kb = build_keyboard(video_id=video.id)
@@ -299,7 +469,7 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.effective_message.reply_text(
         "Это TikTuk Bot — пародия “тиктока” в телеграме.\n\n"
         "Пришли видео, и я добавлю его в общую ленту.\n"
-        "Команды: /feed /next /prev /random /help"
+        "Команды: /feed /next /prev /random /search /help"
     )
     await send_or_edit_feed(update=update, context=context)
 
@@ -310,7 +480,8 @@ async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         "/feed — открыть ленту\n"
         "/next — следующее\n"
         "/prev — предыдущее\n"
-        "/random — случайное\n\n"
+        "/random — случайное\n"
+        "/search текст — поиск по описаниям и комментариям\n\n"
         "Также можно: просто прислать видео/анимацию — это добавит в ленту."
     )
 
@@ -319,37 +490,73 @@ async def cmd_feed(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await send_or_edit_feed(update=update, context=context)
 
 
+def _step(user_id: int, direction: str) -> Optional[Video]:
+    """The video after/before the user's current one (staying put at either end), or a shuffled one."""
+    if direction == "rand":
+        return store.next_shuffled(user_id) or store.current_video(user_id)
+    current_id = nav_state.get(user_id).video_id
+    if current_id is None:
+        current = store.current_video(user_id)
+        if current is None:
+            return None
+        current_id = current.id
+    # One indexed lookup from the saved id; it doesn't matter whether that video still exists.
+    step = store.next_video(current_id) if direction == "next" else store.prev_video(current_id)
+    return step or store.current_video(user_id)
+
+
 async def cmd_next(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     if not user:
         return
-    total = store.count_videos()
-    if total == 0:
-        await cmd_feed(update, context)
-        return
-    idx = store.get_user_idx(user.id)
-    await send_or_edit_feed(update=update, context=context, force_idx=min(total - 1, idx + 1))
+    await send_or_edit_feed(update=update, context=context, video=_step(user.id, "next"))
 
 
 async def cmd_prev(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     if not user:
         return
-    idx = store.get_user_idx(user.id)
-    await send_or_edit_feed(update=update, context=context, force_idx=max(0, idx - 1))
+    await send_or_edit_feed(update=update, context=context, video=_step(user.id, "prev"))
 
 
 async def cmd_random(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    import random
-
     user = update.effective_user
     if not user:
         return
-    total = store.count_videos()
-    if total == 0:
-        await cmd_feed(update, context)
+    await send_or_edit_feed(update=update, context=context, video=_step(user.id, "rand"))
+
+
+def render_search_page(query: str, page: int) -> tuple[str, Optional[InlineKeyboardMarkup]]:
+    total, videos = store.search(query, limit=SEARCH_PAGE_SIZE, offset=page * SEARCH_PAGE_SIZE)
+    if not videos:
+        return f"По запросу “{query}” ничего не нашлось.", None
+    pages = (total + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE
+    lines = [f"Поиск “{query}”: {total} (стр. {page + 1}/{pages})", ""]
+    rows = []
+    for n, video in enumerate(videos, start=page * SEARCH_PAGE_SIZE + 1):
+        caption = render_caption(video)
+        short = caption if len(caption) <= 40 else caption[:40] + "…"
+        lines.append(f"{n}. {short}")
+        rows.append([InlineKeyboardButton(f"{n}. {short}", callback_data=f"open:{video.id}")])
+    paging = []
+    if page > 0:
+        paging.append(InlineKeyboardButton("◀️", callback_data=f"search:{page - 1}"))
+    if page + 1 < pages:
+        paging.append(InlineKeyboardButton("▶️", callback_data=f"search:{page + 1}"))
+    if paging:
+        rows.append(paging)
+    return "\n".join(lines), InlineKeyboardMarkup(rows)
+
+
+async def cmd_search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = " ".join(context.args or []).strip()
+    if not query:
+        await update.effective_message.reply_text("Напиши, что искать: /search неон")
         return
-    await send_or_edit_feed(update=update, context=context, force_idx=random.randint(0, total - 1))
+    # Callback data is capped at 64 bytes, so paging buttons carry only the page and the query lives here.
+    context.user_data["search_query"] = query
+    text, kb = render_search_page(query, 0)
+    await update.effective_message.reply_text(text, reply_markup=kb)
 
 
 async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -364,23 +571,39 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     await q.answer()
 
     if data.startswith("nav:"):
-        direction = data.split(":", 1)[1]
-        total = store.count_videos()
-        if total == 0:
+        video = _step(user.id, data.split(":", 1)[1])
+        if video is None:
             await q.message.reply_text("Пока нет видео. Пришли мне видео.")
             return
+        await send_or_edit_feed(update=update, context=context, message_to_edit=q.message, video=video)
+        return
+
+    if data.startswith("search:"):
+        try:
+            page = max(0, int(data.split(":", 1)[1]))
+        except ValueError:
+            return
+        query = context.user_data.get("search_query")
+        if not query:
+            await q.message.reply_text("Поиск устарел — повтори /search.")
+            return
+        text, kb = render_search_page(query, page)
+        try:
+            await q.message.edit_text(text, reply_markup=kb)
+        except Exception:
+            pass
+        return
 
-        idx = store.get_user_idx(user.id)
-        if direction == "next":
-            idx = min(total - 1, idx + 1)
-        elif direction == "prev":
-            idx = max(0, idx - 1)
-        elif direction == "rand":
-            import random
-
-            idx = random.randint(0, total - 1)
-        store.set_user_idx(user.id, idx)
-        await send_or_edit_feed(update=update, context=context, message_to_edit=q.message, force_idx=idx)
+    if data.startswith("open:"):
+        try:
+            video_id = int(data.split(":", 1)[1])
+        except ValueError:
+            return
+        video = store.get_by_id(video_id)
+        if video is None:
+            await q.message.reply_text("Этого видео уже нет в ленте.")
+            return
+        await send_or_edit_feed(update=update, context=context, video=video)
         return
 
     if data.startswith("like:"):
@@ -483,6 +706,18 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         pass
 
 
+def run_compaction_forever() -> None:
+    log = logging.getLogger("archive")
+    while True:
+        try:
+            comments, likes = archive.compact_bot_db(open_db, ARCHIVE_DIR)
+            if comments or likes:
+                log.info("archived %d comments, %d likes", comments, likes)
+        except Exception:
+            log.exception("compaction failed")
+        threading.Event().wait(archive.INTERVAL_S)
+
+
 def main() -> None:
     logging.basicConfig(level=logging.INFO, format="%(levelname)s %(name)s: %(message)s")
 
@@ -491,6 +726,8 @@ def main() -> None:
         raise SystemExit("Missing TELEGRAM_BOT_TOKEN env var")
 
     init_db()
+    migrate_user_state()
+    threading.Thread(target=run_compaction_forever, name="compaction", daemon=True).start()
 
     app = Application.builder().token(token).build()
 
@@ -500,12 +737,16 @@ def main() -> None:
     app.add_handler(CommandHandler("next", cmd_next))
     app.add_handler(CommandHandler("prev", cmd_prev))
     app.add_handler(CommandHandler("random", cmd_random))
+    app.add_handler(CommandHandler("search", cmd_search))
 
     app.add_handler(CallbackQueryHandler(on_callback))
     app.add_handler(MessageHandler(filters.VIDEO | filters.ANIMATION, on_video))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_text))
 
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    try:
+        app.run_polling(allowed_updates=Update.ALL_TYPES)
+    finally:
+        nav_state.close()
 
 
 if __name__ == "__main__":
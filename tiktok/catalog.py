@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Clip catalog for server.py, loaded from a JSON file and reloaded when the file changes.
+
+Each clip is indexed by id and pre-encoded once per load, split around its like count, so a feed
+response is a join of ready-made byte fragments with only the live like numbers filled in.
+"""
+
+from __future__ import annotations
+
+import os
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+import jsonenc
+from counters import KEY_MAX
+
+
+RELOAD_CHECK_S = 1.0
+
+
+def _dumps(data: Any) -> str:
+  # Same encoding the handlers use for responses.
+  return jsonenc.dumps(data)
+
+
+@dataclass(frozen=True)
+class Clip:
+  id: str
+  record: dict[str, Any]
+  likes: int
+  head: bytes
+  tail: bytes
+
+  @classmethod
+  def from_record(cls, record: dict[str, Any]) -> "Clip":
+    stats = dict(record.get("stats") or {})
+    try:
+      likes = int(stats.pop("likes", 0))
+    except (TypeError, ValueError):
+      likes = 0
+    rest = {k: v for k, v in record.items() if k != "stats"}
+    # {"id":...,"palette":[...],"stats":{"likes":<N>,"comments":...,"shares":...}}
+    head = _dumps(rest)[:-1] + ("," if rest else "") + '"stats":{"likes":'
+    tail = ("," + _dumps(stats)[1:] if stats else "}") + "}"
+    return cls(id=str(record["id"]), record=record, likes=likes, head=head.encode("utf-8"), tail=tail.encode("utf-8"))
+
+  def encode(self, likes: int | None = None) -> bytes:
+    return self.head + str(self.likes if likes is None else likes).encode("ascii") + self.tail
+
+
+@dataclass(frozen=True)
+class Snapshot:
+  clips: tuple[Clip, ...]
+  by_id: dict[str, Clip]
+  stamp: tuple[int, int]
+
+
+def _load(path: Path) -> Snapshot:
+  st = path.stat()
+  data = jsonenc.loads(path.read_bytes())
+  records = data.get("clips") if isinstance(data, dict) else data
+  if not isinstance(records, list):
+    raise ValueError(f"{path}: expected a list of clips")
+  clips: list[Clip] = []
+  by_id: dict[str, Clip] = {}
+  for rec in records:
+    if not isinstance(rec, dict):
+      continue
+    clip_id = rec.get("id")
+    if not isinstance(clip_id, str) or not clip_id or len(clip_id.encode("utf-8")) > KEY_MAX or clip_id in by_id:
+      continue
+    if not isinstance(rec.get("stats") or {}, dict):
+      # Skipped like a bad id: one malformed clip shouldn't cost the whole reload.
+      continue
+    clip = Clip.from_record(rec)
+    clips.append(clip)
+    by_id[clip.id] = clip
+  return Snapshot(clips=tuple(clips), by_id=by_id, stamp=(st.st_mtime_ns, st.st_size))
+
+
+class Catalog:
+  def __init__(self, path: Path) -> None:
+    self.path = path
+    self._lock = threading.Lock()
+    self._checked = time.monotonic()
+    self._snap = _load(path)
+    self._failed: tuple[int, int] | None = None
+
+  def snapshot(self) -> Snapshot:
+    """Current catalog; stats the file at most once per RELOAD_CHECK_S and swaps in a new one if it changed."""
+    now = time.monotonic()
+    if now - self._checked < RELOAD_CHECK_S or not self._lock.acquire(blocking=False):
+      return self._snap
+    try:
+      self._checked = now
+      try:
+        st = os.stat(self.path)
+      except OSError:
+        return self._snap
+      stamp = (st.st_mtime_ns, st.st_size)
+      if stamp != self._snap.stamp and stamp != self._failed:
+        try:
+          self._snap = _load(self.path)
+          print(f"Catalog reloaded: {len(self._snap.clips)} clips from {self.path}")
+        except Exception as e:
+          # Half-written or broken file: keep serving the previous catalog until the file changes again.
+          self._failed = stamp
+          print(f"Catalog reload failed, keeping previous: {e!r}")
+      return self._snap
+    finally:
+      self._lock.release()
+
+  def get(self, clip_id: str) -> Clip | None:
+    return self.snapshot().by_id.get(clip_id)
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Like counters shared by several server.py worker processes through one memory-mapped file.
+
+Layout (little-endian): a 64-byte header followed by fixed 64-byte slots.
+
+  header: magic[8] | nslots u32 | reserved u32 | updated_ms i64 | checkpoint_ms i64 | padding
+  slot:   key_len u8 | key[55] (utf-8) | value i64
+
+A clip id is placed by linear probing from crc32(id), so every process finds the same slot without
+coordination. Slots are claimed under a lock on the header and updated under a byte-range lock on the
+slot itself (fcntl record locks across processes, a threading lock within one).
+"""
+
+from __future__ import annotations
+
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Iterator
+
+
+MAGIC = b"TTCNT1\0\0"
+HEADER = struct.Struct("<8sIIqq")
+HEADER_SIZE = 64
+SLOT_SIZE = 64
+KEY_MAX = 55
+VALUE = struct.Struct("<q")
+VALUE_OFFSET = 56
+DEFAULT_SLOTS = 1 << 18
+
+
+def _now_ms() -> int:
+  return int(time.time() * 1000)
+
+
+def read_snapshot(path: Path) -> tuple[dict[str, int], int] | None:
+  """(counters, updated_ms) read from a live counter file without writing to it.
+
+  Unlike SharedCounters, this never creates, resizes or reinitialises the file. Returns None when it
+  is missing or doesn't look like a valid counter file.
+  """
+  try:
+    fd = os.open(path, os.O_RDONLY)
+  except FileNotFoundError:
+    return None
+  try:
+    size = os.fstat(fd).st_size
+    if size < HEADER_SIZE:
+      return None
+    magic, nslots, _, updated_ms, _ = HEADER.unpack(os.pread(fd, HEADER.size, 0))
+    end = HEADER_SIZE + nslots * SLOT_SIZE
+    if magic != MAGIC or nslots <= 0 or size < end:
+      return None
+    with mmap.mmap(fd, end, access=mmap.ACCESS_READ) as mm:
+      # Shared lock over the table: writers hold exclusive slot locks, so this waits out updates in flight.
+      fcntl.lockf(fd, fcntl.LOCK_SH, end - HEADER_SIZE, HEADER_SIZE)
+      try:
+        raw = mm[HEADER_SIZE:end]
+      finally:
+        fcntl.lockf(fd, fcntl.LOCK_UN, end - HEADER_SIZE, HEADER_SIZE)
+  finally:
+    os.close(fd)
+  out: dict[str, int] = {}
+  for off in range(0, len(raw), SLOT_SIZE):
+    n = raw[off]
+    if not n:
+      continue
+    if n > KEY_MAX:
+      return None
+    try:
+      key = raw[off + 1:off + 1 + n].decode("utf-8")
+    except UnicodeDecodeError:
+      return None
+    out[key] = VALUE.unpack_from(raw, off + VALUE_OFFSET)[0]
+  return out, updated_ms
+
+
+class SharedCounters:
+  def __init__(self, path: Path, nslots: int = DEFAULT_SLOTS) -> None:
+    self.path = path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    self._local = threading.Lock()
+    self._ckpt_local = threading.Lock()
+    self._slots: dict[str, int] = {}
+    self.created = False
+    with self._file_lock(0, HEADER_SIZE):
+      size = os.fstat(self._fd).st_size
+      if size < HEADER_SIZE or os.pread(self._fd, len(MAGIC), 0) != MAGIC:
+        os.ftruncate(self._fd, 0)
+        os.ftruncate(self._fd, HEADER_SIZE + nslots * SLOT_SIZE)
+        os.pwrite(self._fd, HEADER.pack(MAGIC, nslots, 0, _now_ms(), 0), 0)
+        self.created = True
+      (_, self.nslots, _, _, _) = HEADER.unpack(os.pread(self._fd, HEADER.size, 0))
+    self._mm = mmap.mmap(self._fd, HEADER_SIZE + self.nslots * SLOT_SIZE)
+
+  # -- locking -------------------------------------------------------------------------------------
+
+  @contextmanager
+  def _file_lock(self, start: int, length: int) -> Iterator[None]:
+    # fcntl record locks are per process, so threads of one process also need the local lock.
+    with self._local:
+      fcntl.lockf(self._fd, fcntl.LOCK_EX, length, start)
+      try:
+        yield
+      finally:
+        fcntl.lockf(self._fd, fcntl.LOCK_UN, length, start)
+
+  # -- slots ---------------------------------------------------------------------------------------
+
+  def _slot_offset(self, slot: int) -> int:
+    return HEADER_SIZE + slot * SLOT_SIZE
+
+  def _slot_key(self, slot: int) -> bytes:
+    off = self._slot_offset(slot)
+    n = self._mm[off]
+    return bytes(self._mm[off + 1:off + 1 + n]) if n else b""
+
+  def _probe(self, key: bytes) -> tuple[int | None, int | None]:
+    """Return (slot holding key, first empty slot on the probe path)."""
+    start = zlib.crc32(key) % self.nslots
+    for i in range(self.nslots):
+      slot = (start + i) % self.nslots
+      cur = self._slot_key(slot)
+      if not cur:
+        return None, slot
+      if cur == key:
+        return slot, None
+    return None, None
+
+  def _encode(self, clip_id: str) -> bytes:
+    key = clip_id.encode("utf-8")
+    if not key or len(key) > KEY_MAX:
+      raise ValueError(f"counter key must be 1..{KEY_MAX} bytes")
+    return key
+
+  def _find(self, clip_id: str) -> int | None:
+    slot = self._slots.get(clip_id)
+    if slot is not None:
+      return slot
+    found, _ = self._probe(self._encode(clip_id))
+    if found is not None:
+      self._slots[clip_id] = found
+    return found
+
+  def _find_or_claim(self, clip_id: str) -> int:
+    slot = self._find(clip_id)
+    if slot is not None:
+      return slot
+    key = self._encode(clip_id)
+    with self._file_lock(0, HEADER_SIZE):
+      # Someone may have claimed it between the unlocked probe and taking the lock.
+      found, empty = self._probe(key)
+      if found is None:
+        if empty is None:
+          raise RuntimeError(f"counter file {self.path} is full ({self.nslots} slots)")
+        off = self._slot_offset(empty)
+        VALUE.pack_into(self._mm, off + VALUE_OFFSET, 0)
+        self._mm[off + 1:off + 1 + len(key)] = key
+        # Length goes last: lock-free readers see either an empty slot or the whole key.
+        self._mm[off] = len(key)
+        found = empty
+    self._slots[clip_id] = found
+    return found
+
+  # -- public API ----------------------------------------------------------------------------------
+
+  def get(self, clip_id: str) -> int | None:
+    """Current value, or None if this id was never counted."""
+    try:
+      slot = self._find(clip_id)
+    except ValueError:
+      return None
+    if slot is None:
+      return None
+    return VALUE.unpack_from(self._mm, self._slot_offset(slot) + VALUE_OFFSET)[0]
+
+  def add(self, clip_id: str, delta: int, floor: int = 0) -> int:
+    """Atomically add delta (clamped at floor) and return the new value."""
+    slot = self._find_or_claim(clip_id)
+    off = self._slot_offset(slot)
+    with self._file_lock(off, SLOT_SIZE):
+      (cur,) = VALUE.unpack_from(self._mm, off + VALUE_OFFSET)
+      nxt = max(floor, cur + delta)
+      VALUE.pack_into(self._mm, off + VALUE_OFFSET, nxt)
+    self._touch()
+    return nxt
+
+  def set(self, clip_id: str, value: int) -> None:
+    slot = self._find_or_claim(clip_id)
+    off = self._slot_offset(slot)
+    with self._file_lock(off, SLOT_SIZE):
+      VALUE.pack_into(self._mm, off + VALUE_OFFSET, value)
+    self._touch()
+
+  def items(self) -> Iterator[tuple[str, int]]:
+    for slot in range(self.nslots):
+      key = self._slot_key(slot)
+      if key:
+        yield key.decode("utf-8"), VALUE.unpack_from(self._mm, self._slot_offset(slot) + VALUE_OFFSET)[0]
+
+  def snapshot(self) -> dict[str, int]:
+    """Point-in-time copy of every counter; all slots are locked only for the raw memory copy."""
+    end = HEADER_SIZE + self.nslots * SLOT_SIZE
+    with self._file_lock(HEADER_SIZE, end - HEADER_SIZE):
+      raw = self._mm[HEADER_SIZE:end]
+    out: dict[str, int] = {}
+    for off in range(0, len(raw), SLOT_SIZE):
+      n = raw[off]
+      if n:
+        out[raw[off + 1:off + 1 + n].decode("utf-8")] = VALUE.unpack_from(raw, off + VALUE_OFFSET)[0]
+    return out
+
+  @property
+  def updated_ms(self) -> int:
+    return HEADER.unpack_from(self._mm, 0)[3]
+
+  @property
+  def checkpoint_ms(self) -> int:
+    return HEADER.unpack_from(self._mm, 0)[4]
+
+  def _touch(self) -> None:
+    # Plain 8-byte store; concurrent writers race only to store roughly the same timestamp.
+    struct.pack_into("<q", self._mm, 16, _now_ms())
+
+  def checkpoint(self, write: Callable[[dict[str, int], int], None]) -> bool:
+    """Hand a snapshot to `write` if anything changed since the last checkpoint, one process at a time.
+
+    Returns False when another process is already checkpointing.
+    """
+    # The checkpoint lock is a byte past the end of the table, so it never blocks slot claims or updates.
+    lock_at = HEADER_SIZE + self.nslots * SLOT_SIZE
+    with self._ckpt_local:
+      try:
+        fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, lock_at)
+      except OSError:
+        return False
+      try:
+        started = _now_ms()
+        updated = self.updated_ms
+        if updated <= self.checkpoint_ms:
+          return True
+        write(dict(self.items()), updated)
+        self._mm.flush()
+        # A change landing in the same millisecond as the snapshot may be missing from it; leave that
+        # millisecond dirty so the next round picks it up.
+        struct.pack_into("<q", self._mm, 24, min(updated, started - 1))
+        return True
+      finally:
+        fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, lock_at)
+
+  def close(self) -> None:
+    self._mm.flush()
+    self._mm.close()
+    os.close(self._fd)
@@ -0,0 +1,183 @@
+from __future__ import annotations
+
+import argparse
+import csv
+import hashlib
+import os
+import shutil
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Iterable, Iterator
+
+import jsonenc
+
+
+BATCH_SIZE = 5000
+HASH_CHUNK = 1024 * 1024
+
+
+class Progress:
+    def __init__(self, label: str, every_s: float = 1.0) -> None:
+        self.label = label
+        self.every_s = every_s
+        self.started = time.monotonic()
+        self._last = 0.0
+
+    def report(self, done: int, added: int, *, final: bool = False) -> None:
+        now = time.monotonic()
+        if not final and now - self._last < self.every_s:
+            return
+        self._last = now
+        rate = done / max(now - self.started, 1e-6)
+        print(f"{self.label}: {done} processed, {added} added, {done - added} skipped ({rate:.0f}/s)", file=sys.stderr)
+
+
+def _read_manifest(path: Path) -> Iterator[dict[str, Any]]:
+    if path.suffix.lower() == ".jsonl":
+        with path.open(encoding="utf-8") as fh:
+            for n, line in enumerate(fh, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    row = jsonenc.loads(line)
+                except ValueError:
+                    print(f"{path}:{n}: invalid JSON, skipped", file=sys.stderr)
+                    continue
+                if isinstance(row, dict):
+                    yield row
+        return
+    with path.open(encoding="utf-8", newline="") as fh:
+        yield from csv.DictReader(fh)
+
+
+def _bot_rows(rows: Iterable[dict[str, Any]], *, added_by: int, added_at: str) -> Iterator[tuple[Any, ...] | None]:
+    # Same normalisation as Store.add_video; None marks a row that can't be imported.
+    for row in rows:
+        file_id = str(row.get("file_id") or "").strip()
+        file_unique_id = str(row.get("file_unique_id") or "").strip()
+        media_type = str(row.get("media_type") or "video").strip()
+        if not file_id or not file_unique_id or media_type not in {"video", "animation"}:
+            yield None
+            continue
+        caption = str(row.get("caption") or "").strip()[:280]
+        yield (file_id, file_unique_id, media_type, caption, added_at, added_by)
+
+
+def ingest_bot_manifest(manifest: Path, *, added_by: int = 0, batch_size: int = BATCH_SIZE) -> tuple[int, int]:
+    """Import a CSV/JSONL manifest into the bot DB. Rows whose file_unique_id is already known are skipped."""
+    from bot import init_db, open_db, utc_iso
+
+    init_db()
+    progress = Progress(f"bot <- {manifest.name}")
+    done = added = 0
+    conn = open_db()
+    try:
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        batch: list[tuple[Any, ...]] = []
+
+        def flush() -> None:
+            nonlocal added
+            if not batch:
+                return
+            with conn:
+                # rowcount, not total_changes: the latter also counts the search index rows the triggers write.
+                cur = conn.executemany(
+                    """
+                    INSERT OR IGNORE INTO videos (file_id, file_unique_id, media_type, caption, added_at, added_by)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    """,
+                    batch,
+                )
+            added += cur.rowcount
+            batch.clear()
+
+        for row in _bot_rows(_read_manifest(manifest), added_by=added_by, added_at=utc_iso()):
+            done += 1
+            if row is not None:
+                batch.append(row)
+            if len(batch) >= batch_size:
+                flush()
+                progress.report(done, added)
+        flush()
+    finally:
+        conn.close()
+    progress.report(done, added, final=True)
+    return done, added
+
+
+def _file_digest(path: Path) -> str:
+    h = hashlib.sha256()
+    with path.open("rb") as fh:
+        while chunk := fh.read(HASH_CHUNK):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _video_files(root: Path, exts: set[str]) -> list[Path]:
+    if not root.is_dir():
+        return []
+    return sorted((p for p in root.rglob("*") if p.is_file() and p.suffix.lower() in exts), key=lambda p: str(p).lower())
+
+
+def ingest_web_dir(source: Path, *, workers: int = os.cpu_count() or 4) -> tuple[int, int]:
+    """Copy a directory of videos into the web library, skipping files whose content is already there."""
+    from werkzeug.utils import secure_filename
+
+    from app import ALLOWED_VIDEO_EXTS, VIDEOS_DIR, _upload_target
+
+    incoming = _video_files(source, ALLOWED_VIDEO_EXTS)
+    existing = [p for p in _video_files(VIDEOS_DIR, ALLOWED_VIDEO_EXTS) if p.parent == VIDEOS_DIR]
+    progress = Progress(f"web <- {source}")
+
+    # Only files that share a size with some other file can be duplicates, so only those get hashed.
+    sizes = Counter(p.stat().st_size for p in incoming + existing)
+    to_hash = [p for p in incoming + existing if sizes[p.stat().st_size] > 1]
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        digests = dict(zip(to_hash, pool.map(_file_digest, to_hash)))
+
+    seen = {digests[p] for p in existing if p in digests}
+    done = added = 0
+    for src in incoming:
+        done += 1
+        digest = digests.get(src)
+        if digest is not None:
+            if digest in seen:
+                progress.report(done, added)
+                continue
+            seen.add(digest)
+        filename = secure_filename(src.name)
+        if not filename:
+            continue
+        shutil.copyfile(src, _upload_target(filename))
+        added += 1
+        progress.report(done, added)
+    progress.report(done, added, final=True)
+    return done, added
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Bulk-import videos into the bot feed or the web library.")
+    sub = parser.add_subparsers(dest="target", required=True)
+
+    p_bot = sub.add_parser("bot", help="import a CSV/JSONL manifest (file_id, file_unique_id, caption[, media_type])")
+    p_bot.add_argument("manifest", type=Path)
+    p_bot.add_argument("--added-by", type=int, default=0, help="user id recorded as the uploader")
+    p_bot.add_argument("--batch", type=int, default=BATCH_SIZE, help="rows per transaction")
+
+    p_web = sub.add_parser("web", help="copy a directory of video files into static/videos")
+    p_web.add_argument("source", type=Path)
+    p_web.add_argument("--workers", type=int, default=os.cpu_count() or 4, help="parallel hashing threads")
+
+    args = parser.parse_args()
+    if args.target == "bot":
+        ingest_bot_manifest(args.manifest, added_by=args.added_by, batch_size=max(1, args.batch))
+    else:
+        ingest_web_dir(args.source, workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
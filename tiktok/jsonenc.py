@@ -0,0 +1,49 @@
+"""JSON encoding shared by app.py, server.py and the command-line tools.
+
+Uses orjson when it is installed (`pip install orjson`) and the stdlib json module otherwise. Both
+backends write the same compact form: no spaces, non-ASCII left as UTF-8. Clients and on-disk files
+therefore don't depend on which backend is present.
+"""
+
+from __future__ import annotations
+
+import json
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:  # optional dependency
+    orjson = None
+
+
+BACKEND = "orjson" if orjson is not None else "json"
+
+
+def _std_dumps(obj: Any) -> str:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+if orjson is not None:
+    _OPTIONS = orjson.OPT_NON_STR_KEYS
+
+    def dumpb(obj: Any) -> bytes:
+        try:
+            return orjson.dumps(obj, option=_OPTIONS)
+        except TypeError:
+            # orjson refuses a few things the stdlib accepts (e.g. ints wider than 64 bits).
+            return _std_dumps(obj).encode("utf-8")
+
+    def loads(data: Union[bytes, str]) -> Any:
+        return orjson.loads(data)
+
+else:
+
+    def dumpb(obj: Any) -> bytes:
+        return _std_dumps(obj).encode("utf-8")
+
+    def loads(data: Union[bytes, str]) -> Any:
+        return json.loads(data)
+
+
+def dumps(obj: Any) -> str:
+    return dumpb(obj).decode("utf-8")
@@ -0,0 +1,209 @@
+from __future__ import annotations
+
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Optional
+
+
+log = logging.getLogger(__name__)
+
+CACHE_SIZE = 50_000
+FLUSH_INTERVAL_S = 0.5
+FLUSH_BATCH = 500
+
+
+@dataclass
+class UserNav:
+    # Legacy feed position (OFFSET into videos); only read to find video_id for users from before it existed.
+    idx: int = 0
+    pending_comment_video_id: Optional[int] = None
+    # Position in the user's shuffled order, see shuffle.shuffled_position.
+    shuffle_cursor: int = 0
+    # The video the user is on; next/prev step from it by primary key.
+    video_id: Optional[int] = None
+
+    def copy(self) -> "UserNav":
+        return UserNav(self.idx, self.pending_comment_video_id, self.shuffle_cursor, self.video_id)
+
+
+class NavState:
+    """Per-user feed position and pending-comment target, kept out of the main bot database.
+
+    Reads come from an LRU cache; writes land in the cache and are group-committed to a separate
+    SQLite file by a background thread, so nav taps never take the main database's write lock.
+    Pending-comment changes are committed before returning, so they survive a restart.
+    """
+
+    def __init__(self, path: Path, *, capacity: int = CACHE_SIZE) -> None:
+        self.path = path
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._cache: OrderedDict[int, UserNav] = OrderedDict()
+        # Changes not yet committed. Survives cache eviction, so an evicted user never reads stale state.
+        self._dirty: dict[int, UserNav] = {}
+        self._inflight: dict[int, UserNav] = {}
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._db: Optional[sqlite3.Connection] = None
+
+    def _conn(self) -> sqlite3.Connection:
+        if self._db is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL;")
+            conn.execute("PRAGMA synchronous=NORMAL;")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS user_state (
+                  user_id INTEGER PRIMARY KEY,
+                  idx INTEGER NOT NULL DEFAULT 0,
+                  pending_comment_video_id INTEGER NULL,
+                  shuffle_cursor INTEGER NOT NULL DEFAULT 0,
+                  video_id INTEGER NULL
+                )
+                """
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(user_state)")}
+            if "shuffle_cursor" not in columns:
+                conn.execute("ALTER TABLE user_state ADD COLUMN shuffle_cursor INTEGER NOT NULL DEFAULT 0")
+            if "video_id" not in columns:
+                conn.execute("ALTER TABLE user_state ADD COLUMN video_id INTEGER NULL")
+            conn.commit()
+            self._db = conn
+        return self._db
+
+    def _load(self, user_id: int) -> UserNav:
+        with self._db_lock:
+            row = self._conn().execute(
+                "SELECT idx, pending_comment_video_id, shuffle_cursor, video_id FROM user_state WHERE user_id = ?",
+                (user_id,),
+            ).fetchone()
+        if not row:
+            return UserNav()
+        return UserNav(
+            idx=int(row[0]),
+            pending_comment_video_id=int(row[1]) if row[1] is not None else None,
+            shuffle_cursor=int(row[2]),
+            video_id=int(row[3]) if row[3] is not None else None,
+        )
+
+    def get(self, user_id: int) -> UserNav:
+        """A copy of the user's state (defaults for unknown users; nothing is written on read)."""
+        with self._lock:
+            nav = self._cache.get(user_id)
+            if nav is not None:
+                self._cache.move_to_end(user_id)
+                return nav.copy()
+            nav = self._dirty.get(user_id) or self._inflight.get(user_id)
+        if nav is None:
+            nav = self._load(user_id)
+        with self._lock:
+            # Another thread may have written while we were reading the database.
+            nav = self._cache.get(user_id) or self._dirty.get(user_id) or self._inflight.get(user_id) or nav
+            self._remember(user_id, nav)
+            return nav.copy()
+
+    def _remember(self, user_id: int, nav: UserNav) -> None:
+        self._cache[user_id] = nav
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self.capacity:
+            self._cache.popitem(last=False)
+
+    def update(self, user_id: int, *, durable: bool = False, **changes: object) -> None:
+        self.get(user_id)  # make sure the user is cached
+        with self._lock:
+            nav = self._cache.get(user_id) or self._dirty.get(user_id) or self._inflight.get(user_id) or UserNav()
+            for name, value in changes.items():
+                setattr(nav, name, value)
+            self._remember(user_id, nav)
+            self._dirty[user_id] = nav.copy()
+            backlog = len(self._dirty)
+        if durable:
+            self.flush()
+            return
+        self._ensure_flusher()
+        if backlog >= FLUSH_BATCH:
+            self._wake.set()
+
+    def flush(self) -> None:
+        """Commit every pending change in one transaction."""
+        with self._db_lock:
+            with self._lock:
+                batch, self._dirty = self._dirty, {}
+                self._inflight = batch
+            if not batch:
+                return
+            try:
+                conn = self._conn()
+                with conn:
+                    conn.executemany(
+                        """
+                        INSERT INTO user_state (user_id, idx, pending_comment_video_id, shuffle_cursor, video_id)
+                        VALUES (?, ?, ?, ?, ?)
+                        ON CONFLICT(user_id) DO UPDATE SET
+                          idx = excluded.idx,
+                          pending_comment_video_id = excluded.pending_comment_video_id,
+                          shuffle_cursor = excluded.shuffle_cursor,
+                          video_id = excluded.video_id
+                        """,
+                        [
+                            (uid, nav.idx, nav.pending_comment_video_id, nav.shuffle_cursor, nav.video_id)
+                            for uid, nav in batch.items()
+                        ],
+                    )
+            except Exception:
+                with self._lock:
+                    # Put the batch back without clobbering anything newer that arrived meanwhile.
+                    for uid, nav in batch.items():
+                        self._dirty.setdefault(uid, nav)
+                raise
+            finally:
+                with self._lock:
+                    self._inflight = {}
+
+    def _ensure_flusher(self) -> None:
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="nav-flush", daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wake.wait(FLUSH_INTERVAL_S)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                log.exception("nav state flush failed")
+
+    def is_empty(self) -> bool:
+        with self._db_lock:
+            return self._conn().execute("SELECT 1 FROM user_state LIMIT 1").fetchone() is None
+
+    def import_rows(self, rows: Iterable[tuple[int, int, Optional[int]]]) -> None:
+        with self._db_lock:
+            conn = self._conn()
+            with conn:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO user_state (user_id, idx, pending_comment_video_id) VALUES (?, ?, ?)",
+                    rows,
+                )
+
+    def close(self) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        self.flush()
+        with self._db_lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,347 @@
+"""Multi-node replication of likes and comments for app.py and server.py.
+
+Every node owns its own slot in each counter (a PN-counter: separate increment and decrement totals per
+node) and its own append-only comment log, with one sequence number per node covering both. A node's
+version vector records, per origin node, the highest sequence number it has seen. Nodes pull from their
+peers: they send their version vector to POST /api/replica/sync and merge back everything newer. Merging is
+idempotent and order-independent, so nodes converge whatever the timing, and any node can serve the feed.
+
+State lives in data/replica-<node>.json. Each local operation and each merged delta is also appended to
+replica-<node>.log before it is acknowledged. On start the node loads the JSON and replays the log, and the
+log is folded back into the JSON once it grows past COMPACT_BYTES.
+"""
+
+from __future__ import annotations
+
+import os
+import re
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+import urllib.request
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Iterable, Optional
+
+import jsonenc
+
+
+SYNC_INTERVAL_S = 1.0
+SYNC_TIMEOUT_S = 3.0
+COMPACT_BYTES = 4 * 1024 * 1024
+SYNC_PATH = "/api/replica/sync"
+_NODE_ID = re.compile(r"^[A-Za-z0-9_.-]{1,64}$")
+
+
+def _now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+@dataclass(frozen=True)
+class Comment:
+    origin: str
+    seq: int
+    video_id: str
+    text: str
+    ts: str
+
+    def to_wire(self) -> list[Any]:
+        return [self.origin, self.seq, self.video_id, self.text, self.ts]
+
+
+def parse_peers(value: str) -> list[str]:
+    """'http://h1:5050, h2:5050' -> ['http://h1:5050', 'http://h2:5050']"""
+    peers = []
+    for part in (value or "").split(","):
+        part = part.strip().rstrip("/")
+        if part:
+            peers.append(part if "://" in part else f"http://{part}")
+    return peers
+
+
+def read_vv(payload: Any) -> dict[str, int]:
+    """The version vector of a sync request body ({"vv": {origin: seq}}). Raises ValueError if malformed."""
+    if not isinstance(payload, dict):
+        raise ValueError("sync request must be a JSON object")
+    vv = payload.get("vv") or {}
+    if not isinstance(vv, dict):
+        raise ValueError("vv must be an object")
+    for origin, seq in vv.items():
+        if not isinstance(origin, str) or not isinstance(seq, int) or isinstance(seq, bool) or seq < 0:
+            raise ValueError(f"vv[{origin!r}] must be a non-negative integer")
+    return vv
+
+
+class Replica:
+    def __init__(self, node: str, path: Path, peers: Iterable[str] = ()) -> None:
+        if not _NODE_ID.match(node):
+            raise ValueError(f"bad node id {node!r} (letters, digits, '_', '.', '-')")
+        self.node = node
+        self.path = path
+        self.log_path = path.with_suffix(".log")
+        self.peers = list(peers)
+        # Called with comments that arrived from other nodes (e.g. to index them for search).
+        self.on_comments: Optional[Callable[[list[Comment]], None]] = None
+        self._lock = threading.Lock()
+        # key -> origin -> [increments, decrements, seq of the origin's last change to this key]
+        self._counters: dict[str, dict[str, list[int]]] = {}
+        self._comments: dict[tuple[str, int], Comment] = {}
+        self._by_video: dict[str, list[Comment]] = {}
+        self._vv: dict[str, int] = {}
+        # origin -> sorted seqs that are still current (a counter slot's latest change, or a comment), so a
+        # delta walks only the entries a peer is missing; _seq_keys names the counter behind a seq.
+        self._seqs: dict[str, list[int]] = {}
+        self._seq_keys: dict[tuple[str, int], str] = {}
+        self._seq = 0
+        self._down: set[str] = set()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.created = not path.exists() and not self.log_path.exists()
+        self._load()
+        # Wall-clock ms of the last change this node saw, local or merged (server.py's /api/state).
+        self.updated_ms = _now_ms()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._log = open(self.log_path, "ab")
+        self._log_dirty = False
+        if self._log.tell() and self._last_log_byte() != b"\n":
+            # Close off a line cut short by a crash, so the next entry doesn't get glued onto it.
+            self._log.write(b"\n")
+
+    # -- reads -------------------------------------------------------------------------------------------
+
+    def value(self, key: str) -> Optional[int]:
+        """Current count, or None if no node ever counted this key.
+
+        Decrements racing on different nodes can overshoot, so the count is clamped at zero.
+        """
+        with self._lock:
+            slots = self._counters.get(key)
+            return max(0, sum(p - n for p, n, _ in slots.values())) if slots else None
+
+    def comments(self, video_id: str) -> list[dict[str, Any]]:
+        with self._lock:
+            items = sorted(self._by_video.get(video_id, ()), key=lambda c: (c.ts, c.origin, c.seq))
+        return [{"text": c.text, "ts": c.ts} for c in items]
+
+    def comment_count(self, video_id: str) -> int:
+        with self._lock:
+            return len(self._by_video.get(video_id, ()))
+
+    def version_vector(self) -> dict[str, int]:
+        with self._lock:
+            return dict(self._vv)
+
+    # -- local operations --------------------------------------------------------------------------------
+
+    def add(self, key: str, delta: int = 1) -> int:
+        """Apply a local like/unlike and return the new count. A decrement never takes this node's view below 0."""
+        with self._lock:
+            slots = self._counters.get(key, {})
+            current = max(0, sum(p - n for p, n, _ in slots.values()))
+            delta = max(delta, -current)
+            if delta == 0:
+                return current
+            slot = self._counters.setdefault(key, slots).setdefault(self.node, [0, 0, 0])
+            if delta > 0:
+                slot[0] += delta
+            else:
+                slot[1] -= delta
+            self._reindex(key, self.node, slot[2], self._next_seq())
+            slot[2] = self._seq
+            self._append({"counters": {key: {self.node: slot}}, "comments": []})
+            self.updated_ms = _now_ms()
+            return current + delta
+
+    def add_comment(self, video_id: str, text: str, ts: str) -> Comment:
+        with self._lock:
+            comment = Comment(self.node, self._next_seq(), video_id, text, ts)
+            self._put_comment(comment)
+            self._append({"counters": {}, "comments": [comment.to_wire()]})
+            self.updated_ms = _now_ms()
+            return comment
+
+    def _next_seq(self) -> int:
+        self._seq += 1
+        self._vv[self.node] = self._seq
+        return self._seq
+
+    # -- merging -----------------------------------------------------------------------------------------
+
+    def delta_for(self, vv: dict[str, int]) -> dict[str, Any]:
+        """Everything the holder of version vector `vv` (checked by read_vv) hasn't seen, plus our own vector."""
+        with self._lock:
+            out: dict[str, Any] = {"node": self.node, "vv": dict(self._vv), "counters": {}, "comments": []}
+            for origin, seqs in self._seqs.items():
+                for seq in seqs[bisect_right(seqs, vv.get(origin, 0)):]:
+                    key = self._seq_keys.get((origin, seq))
+                    if key is None:
+                        out["comments"].append(self._comments[(origin, seq)].to_wire())
+                    else:
+                        out["counters"].setdefault(key, {})[origin] = list(self._counters[key][origin])
+            return out
+
+    def merge(self, delta: dict[str, Any], *, log: bool = True) -> list[Comment]:
+        """Fold a delta in (idempotent). Returns comments that were new to this node."""
+        with self._lock:
+            changed, fresh = self._merge_locked(delta)
+            if changed:
+                self.updated_ms = _now_ms()
+                if log:
+                    self._append({"counters": delta.get("counters") or {}, "comments": delta.get("comments") or []})
+        return fresh
+
+    def _merge_locked(self, delta: dict[str, Any]) -> tuple[bool, list[Comment]]:
+        changed = False
+        for key, slots in (delta.get("counters") or {}).items():
+            mine = self._counters.setdefault(str(key), {})
+            for origin, (p, n, seq) in slots.items():
+                p, n, seq = int(p), int(n), int(seq)
+                cur = mine.get(origin)
+                if cur is None:
+                    mine[origin] = [p, n, seq]
+                    self._reindex(str(key), origin, None, seq)
+                elif seq > cur[2] or p > cur[0] or n > cur[1]:
+                    mine[origin] = [max(p, cur[0]), max(n, cur[1]), max(seq, cur[2])]
+                    if seq > cur[2]:
+                        self._reindex(str(key), origin, cur[2], seq)
+                else:
+                    continue
+                changed = True
+                self._see(origin, seq)
+        fresh: list[Comment] = []
+        for origin, seq, video_id, text, ts in delta.get("comments") or []:
+            comment = Comment(str(origin), int(seq), str(video_id), str(text), str(ts))
+            if (comment.origin, comment.seq) in self._comments:
+                continue
+            self._put_comment(comment)
+            self._see(comment.origin, comment.seq)
+            fresh.append(comment)
+            changed = True
+        return changed, fresh
+
+    def _see(self, origin: str, seq: int) -> None:
+        if seq > self._vv.get(origin, 0):
+            self._vv[origin] = seq
+        if origin == self.node and seq > self._seq:
+            # Our own operations coming back from a peer (e.g. after restoring an older file): never reuse a seq.
+            self._seq = seq
+
+    def _put_comment(self, comment: Comment) -> None:
+        self._comments[(comment.origin, comment.seq)] = comment
+        self._by_video.setdefault(comment.video_id, []).append(comment)
+        insort(self._seqs.setdefault(comment.origin, []), comment.seq)
+
+    def _reindex(self, key: str, origin: str, old: Optional[int], new: int) -> None:
+        # A counter slot is described by its latest change only; the seq it replaces drops out of the index.
+        seqs = self._seqs.setdefault(origin, [])
+        if old is not None and self._seq_keys.get((origin, old)) == key:
+            del self._seq_keys[(origin, old)]
+            i = bisect_left(seqs, old)
+            if i < len(seqs) and seqs[i] == old:
+                del seqs[i]
+        self._seq_keys[(origin, new)] = key
+        insort(seqs, new)
+
+    # -- persistence -------------------------------------------------------------------------------------
+
+    def _append(self, delta: dict[str, Any]) -> None:
+        # Written (not fsynced) before the caller answers: survives a process crash; fsync happens per sync round.
+        self._log.write(jsonenc.dumpb(delta) + b"\n")
+        self._log.flush()
+        self._log_dirty = True
+
+    def _load(self) -> None:
+        if self.path.exists():
+            state = jsonenc.loads(self.path.read_bytes())
+            self._merge_locked(state)
+            self._seq = max(self._seq, int(state.get("seq", 0)))
+        if self.log_path.exists():
+            with open(self.log_path, "rb") as fh:
+                for line in fh:
+                    try:
+                        self._merge_locked(jsonenc.loads(line))
+                    except ValueError:
+                        # A line cut short by a crash; everything before it is intact.
+                        continue
+
+    def _last_log_byte(self) -> bytes:
+        with open(self.log_path, "rb") as fh:
+            fh.seek(-1, os.SEEK_END)
+            return fh.read(1)
+
+    def compact(self) -> None:
+        """Write the full state to the JSON file and start an empty log."""
+        with self._lock:
+            state = {
+                "node": self.node,
+                "seq": self._seq,
+                "counters": self._counters,
+                "comments": [c.to_wire() for c in self._comments.values()],
+            }
+            tmp = self.path.with_suffix(self.path.suffix + ".tmp")
+            with open(tmp, "wb") as fh:
+                fh.write(jsonenc.dumpb(state))
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.replace(tmp, self.path)
+            self._log.close()
+            self._log = open(self.log_path, "wb")
+            self._log_dirty = False
+
+    def _sync_log(self) -> None:
+        with self._lock:
+            if self._log_dirty:
+                os.fsync(self._log.fileno())
+                self._log_dirty = False
+            size = self._log.tell()
+        if size > COMPACT_BYTES:
+            self.compact()
+
+    # -- anti-entropy ------------------------------------------------------------------------------------
+
+    def pull(self, peer: str) -> int:
+        """Fetch and merge what `peer` has and we don't. Returns the number of new comments."""
+        body = jsonenc.dumpb({"node": self.node, "vv": self.version_vector()})
+        req = urllib.request.Request(
+            peer + SYNC_PATH, data=body, method="POST", headers={"Content-Type": "application/json"}
+        )
+        with urllib.request.urlopen(req, timeout=SYNC_TIMEOUT_S) as resp:
+            delta = jsonenc.loads(resp.read())
+        fresh = self.merge(delta)
+        if fresh and self.on_comments is not None:
+            self.on_comments(fresh)
+        return len(fresh)
+
+    def sync_once(self) -> None:
+        for peer in self.peers:
+            try:
+                self.pull(peer)
+            except Exception as e:
+                if peer not in self._down:
+                    self._down.add(peer)
+                    print(f"replica {self.node}: peer {peer} unreachable ({e!r})")
+                continue
+            if peer in self._down:
+                self._down.discard(peer)
+                print(f"replica {self.node}: peer {peer} is back")
+        self._sync_log()
+
+    def _run(self) -> None:
+        while not self._stop.wait(SYNC_INTERVAL_S):
+            try:
+                self.sync_once()
+            except Exception as e:
+                print(f"replica {self.node}: sync failed: {e!r}")
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="replica-sync", daemon=True)
+            self._thread.start()
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=SYNC_TIMEOUT_S + 1)
+        self.compact()
+        with self._lock:
+            self._log.close()
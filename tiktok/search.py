@@ -0,0 +1,118 @@
+from __future__ import annotations
+
+import heapq
+import re
+import threading
+from bisect import bisect_left, insort
+from typing import Iterable
+
+
+_WORD = re.compile(r"\w+")
+MIN_PREFIX = 2
+# Rough cost of checking one candidate's terms against a prefix, relative to one posting entry in a union.
+FILTER_COST = 8
+_EMPTY: frozenset[int] = frozenset()
+
+
+def tokenize(text: str) -> list[str]:
+    return _WORD.findall((text or "").casefold())
+
+
+class InvertedIndex:
+    """In-memory word index over short texts (captions, comments), updated in place as they arrive.
+
+    Queries are AND over words; the last word also matches as a prefix (search-as-you-type).
+    Results come back in the order documents were first added.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        # Postings hold small ints (insertion ordinals) rather than ids: cheaper sets, and ordering is free.
+        self._postings: dict[str, set[int]] = {}
+        self._terms: dict[int, set[str]] = {}
+        self._ordinals: dict[str, int] = {}
+        self._ids: dict[int, str] = {}
+        self._vocab: list[str] = []
+        self._next = 0
+
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self._ordinals
+
+    def __len__(self) -> int:
+        return len(self._ordinals)
+
+    def doc_ids(self) -> list[str]:
+        with self._lock:
+            return list(self._ordinals)
+
+    def add(self, doc_id: str, text: str) -> None:
+        """Index more text for doc_id (creating it if needed); earlier text stays indexed."""
+        with self._lock:
+            ordinal = self._ordinals.get(doc_id)
+            if ordinal is None:
+                ordinal = self._ordinals[doc_id] = self._next
+                self._ids[ordinal] = doc_id
+                self._terms[ordinal] = set()
+                self._next += 1
+            terms = self._terms[ordinal]
+            for term in tokenize(text):
+                if term in terms:
+                    continue
+                terms.add(term)
+                posting = self._postings.get(term)
+                if posting is None:
+                    posting = self._postings[term] = set()
+                    insort(self._vocab, term)
+                posting.add(ordinal)
+
+    def remove(self, doc_id: str) -> None:
+        with self._lock:
+            ordinal = self._ordinals.pop(doc_id, None)
+            if ordinal is None:
+                return
+            del self._ids[ordinal]
+            for term in self._terms.pop(ordinal, ()):
+                posting = self._postings[term]
+                posting.discard(ordinal)
+                if not posting:
+                    del self._postings[term]
+                    i = bisect_left(self._vocab, term)
+                    if i < len(self._vocab) and self._vocab[i] == term:
+                        del self._vocab[i]
+
+    def replace(self, doc_id: str, texts: Iterable[str]) -> None:
+        self.remove(doc_id)
+        for text in texts:
+            self.add(doc_id, text)
+
+    def _prefix_terms(self, prefix: str) -> list[str]:
+        lo = bisect_left(self._vocab, prefix)
+        hi = bisect_left(self._vocab, prefix + "\U0010ffff", lo)
+        return self._vocab[lo:hi]
+
+    def search(self, query: str, *, limit: int = 20, offset: int = 0) -> tuple[int, list[str]]:
+        """Return (total matches, doc ids of the requested page)."""
+        words = tokenize(query)
+        if not words:
+            return 0, []
+        prefix = words.pop() if len(words[-1]) >= MIN_PREFIX else None
+        with self._lock:
+            exact = sorted((self._postings.get(w, _EMPTY) for w in words), key=len)
+            hits: set[int]
+            if prefix is None:
+                hits = exact[0].intersection(*exact[1:]) if len(exact) > 1 else exact[0]
+            else:
+                postings = self._postings
+                expansion = [postings[t] for t in self._prefix_terms(prefix)]
+                base = (exact[0].intersection(*exact[1:]) if len(exact) > 1 else exact[0]) if exact else None
+                if base is not None and len(base) * FILTER_COST < sum(map(len, expansion)):
+                    # Few candidates from the exact words: check their terms instead of unioning a wide prefix.
+                    terms = self._terms
+                    hits = {o for o in base if any(t.startswith(prefix) for t in terms[o])}
+                else:
+                    hits = set().union(*expansion)
+                    if base is not None:
+                        hits.intersection_update(base)
+            page = heapq.nsmallest(offset + limit, hits)[offset:]
+            ids = [self._ids[o] for o in page]
+        return len(hits), ids
@@ -3,20 +3,45 @@
 
 from __future__ import annotations
 
-import json
+import argparse
+import html
 import os
+import selectors
+import socket
+import threading
 import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from http import HTTPStatus
-from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from pathlib import Path
 from typing import Any
 from urllib.parse import parse_qs, urlparse
 
+import jsonenc
+from catalog import Catalog, Clip, Snapshot
+from counters import SharedCounters
+from replica import SYNC_PATH, Replica, parse_peers, read_vv
+from search import InvertedIndex
+
 
 ROOT = Path(__file__).resolve().parent
 WEB = ROOT / "web"
 DATA = ROOT / "data"
 STATE_PATH = DATA / "state.json"
+# No external videos (offline) — the client renders "fake clips" with neon backgrounds from this catalog.
+CATALOG_PATH = ROOT / "catalog.json"
+# Live like counters, shared by every worker process; state.json is the periodic checkpoint they recover from.
+COUNTERS_PATH = DATA / "likes.counters"
+CHECKPOINT_INTERVAL_S = 2.0
+
+# Requests are served by a fixed pool; idle keep-alive connections are parked without a worker and closed after
+# this many seconds.
+KEEPALIVE_TIMEOUT_S = 15
+# A client that stalls in the middle of a request holds its worker at most this long.
+REQUEST_TIMEOUT_S = 10
+WORKERS = 32
+MAX_CONNECTIONS = 512
 
 
 def _now_ms() -> int:
@@ -25,63 +50,20 @@ def _now_ms() -> int:
 
 def _read_json(path: Path, default: Any) -> Any:
   try:
-    return json.loads(path.read_text(encoding="utf-8"))
+    return jsonenc.loads(path.read_bytes())
   except Exception:
     return default
 
 
 def _atomic_write_text(path: Path, text: str) -> None:
   tmp = path.with_suffix(path.suffix + ".tmp")
-  tmp.write_text(text, encoding="utf-8")
+  with tmp.open("w", encoding="utf-8") as f:
+    f.write(text)
+    f.flush()
+    os.fsync(f.fileno())
   os.replace(tmp, path)
 
 
-def _seed_feed() -> list[dict[str, Any]]:
-  # No external videos (offline) — we render "fake clips" with neon backgrounds on the client.
-  return [
-    {
-      "id": "np-clip-001",
-      "user": {"name": "neonpuff", "tag": "@neonpuff"},
-      "caption": "NeonPuff. Вкусы, которые цепляют. #neon #puff #vibe",
-      "music": "NEONPUFF — Demo Beat",
-      "palette": ["#3cf3b0", "#55d7ff", "#d86cff"],
-      "stats": {"likes": 1240, "comments": 78, "shares": 54},
-    },
-    {
-      "id": "np-clip-002",
-      "user": {"name": "mint", "tag": "@ice.mint"},
-      "caption": "Ice‑настроение. Чисто, холодно, ровно. #ice #mint",
-      "music": "ICE LOOP — 120bpm",
-      "palette": ["#55d7ff", "#3cf3b0", "#bba6ff"],
-      "stats": {"likes": 980, "comments": 41, "shares": 19},
-    },
-    {
-      "id": "np-clip-003",
-      "user": {"name": "berries", "tag": "@berry.rush"},
-      "caption": "Синий вайб на ночь. #berries #blue",
-      "music": "BERRY WAVE — slowed",
-      "palette": ["#4f8cff", "#7c3aed", "#55d7ff"],
-      "stats": {"likes": 1455, "comments": 120, "shares": 88},
-    },
-    {
-      "id": "np-clip-004",
-      "user": {"name": "tropical", "tag": "@trop.mix"},
-      "caption": "Тропики без приторности. #tropical #mango",
-      "music": "MANGO SNAP — remix",
-      "palette": ["#fb7185", "#f97316", "#facc15"],
-      "stats": {"likes": 1112, "comments": 67, "shares": 42},
-    },
-    {
-      "id": "np-clip-005",
-      "user": {"name": "cola", "tag": "@cola.ice"},
-      "caption": "Классика, которая не стареет. #cola #ice",
-      "music": "COLA CLICK — demo",
-      "palette": ["#f59e0b", "#ef4444", "#a16207"],
-      "stats": {"likes": 802, "comments": 33, "shares": 17},
-    },
-  ]
-
-
 def _load_state() -> dict[str, Any]:
   DATA.mkdir(parents=True, exist_ok=True)
   state = _read_json(STATE_PATH, {})
@@ -92,13 +74,72 @@ def _load_state() -> dict[str, Any]:
   return state
 
 
-def _save_state(state: dict[str, Any]) -> None:
-  state["updated_ms"] = _now_ms()
-  _atomic_write_text(STATE_PATH, json.dumps(state, ensure_ascii=False, indent=2))
+def _save_state(likes: dict[str, int], updated_ms: int) -> None:
+  state = {"likes": likes, "updated_ms": updated_ms}
+  _atomic_write_text(STATE_PATH, jsonenc.dumps(state))
+
+
+def _open_counters() -> SharedCounters:
+  counters = SharedCounters(COUNTERS_PATH)
+  if counters.created:
+    # Fresh (or unreadable) counter file: start from the last checkpoint.
+    for clip_id, likes in _load_state().get("likes", {}).items():
+      try:
+        counters.set(str(clip_id), int(likes))
+      except (TypeError, ValueError):
+        pass
+  return counters
+
+
+def _checkpoint() -> None:
+  COUNTERS.checkpoint(_save_state)
+
 
+def _checkpoint_loop() -> None:
+  while True:
+    time.sleep(CHECKPOINT_INTERVAL_S)
+    try:
+      _checkpoint()
+    except Exception as e:
+      print(f"checkpoint failed: {e!r}")
 
-FEED = _seed_feed()
-STATE = _load_state()
+
+CATALOG = Catalog(CATALOG_PATH)
+# Opened by main() once --data is known.
+COUNTERS: SharedCounters
+# Set by --node: likes then live in the replicated state shared with the --peers nodes.
+REPLICA: Replica | None = None
+SEARCH = InvertedIndex()
+_search_snap: Snapshot | None = None
+_search_lock = threading.Lock()
+
+
+def _clip_texts(clip: Clip) -> list[str]:
+  user = clip.record.get("user") or {}
+  return [str(clip.record.get("caption") or ""), str(user.get("name") or ""), str(user.get("tag") or "")]
+
+
+def _search_index(snap: Snapshot) -> InvertedIndex:
+  # Bring the index up to date with a (re)loaded catalog by touching only clips that changed.
+  global _search_snap
+  if snap is _search_snap:
+    return SEARCH
+  with _search_lock:
+    if snap is not _search_snap:
+      old = _search_snap.by_id if _search_snap is not None else {}
+      for clip_id, clip in old.items():
+        new = snap.by_id.get(clip_id)
+        if new is None or new.record != clip.record:
+          SEARCH.remove(clip_id)
+      for clip in snap.clips:
+        if clip.id not in SEARCH:
+          SEARCH.replace(clip.id, _clip_texts(clip))
+      _search_snap = snap
+  return SEARCH
+
+
+def _likes(clip_id: str) -> int | None:
+  return REPLICA.value(clip_id) if REPLICA is not None else COUNTERS.get(clip_id)
 
 
 def _content_type(path: str) -> str:
@@ -120,29 +161,212 @@ def _content_type(path: str) -> str:
   return "application/octet-stream"
 
 
+class PooledHTTPServer(HTTPServer):
+  """HTTPServer that serves requests from a bounded thread pool and parks idle keep-alive connections.
+
+  A worker only ever holds a connection while a request is being read or answered. Between requests (and
+  before the first one) the socket waits in a selector, so idle keep-alive clients cost a file descriptor,
+  not a worker. At most max_connections are open; past that the longest-idle connection is closed.
+  """
+
+  # socketserver's default listen backlog of 5 drops SYNs as soon as a few clients connect at once.
+  request_queue_size = 128
+
+  def __init__(
+    self,
+    server_address: tuple[str, int],
+    handler: type[BaseHTTPRequestHandler],
+    workers: int = WORKERS,
+    max_connections: int = MAX_CONNECTIONS,
+  ) -> None:
+    super().__init__(server_address, handler)
+    self.max_connections = max_connections
+    self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="http")
+    self._lock = threading.Lock()
+    # Connections handed to the watcher (new, or back from a worker), and the number being served right now.
+    self._incoming: deque[tuple[socket.socket, Any]] = deque()
+    self._busy = 0
+    # Created in serve_forever: with --processes the server is built before fork, and threads/epoll don't fork.
+    self._selector: selectors.BaseSelector | None = None
+    self._wake_r: socket.socket | None = None
+    self._wake_w: socket.socket | None = None
+
+  def serve_forever(self, poll_interval: float = 0.5) -> None:
+    self._selector = selectors.DefaultSelector()
+    self._wake_r, self._wake_w = socket.socketpair()
+    self._wake_r.setblocking(False)
+    self._wake_w.setblocking(False)
+    self._selector.register(self._wake_r, selectors.EVENT_READ)
+    threading.Thread(target=self._watch, name="http-idle", daemon=True).start()
+    super().serve_forever(poll_interval)
+
+  def process_request(self, request: Any, client_address: Any) -> None:
+    # Even a new connection waits in the selector until it has sent something.
+    self._hand_over(request, client_address)
+
+  def _hand_over(self, request: socket.socket, client_address: Any) -> None:
+    with self._lock:
+      self._incoming.append((request, client_address))
+    try:
+      self._wake_w.send(b"\0")
+    except (BlockingIOError, OSError):
+      pass  # the watcher is already due to wake up
+
+  def _watch(self) -> None:
+    selector = self._selector
+    # Parked connections, oldest first: socket -> (client address, parked at).
+    idle: OrderedDict[socket.socket, tuple[Any, float]] = OrderedDict()
+    while True:
+      events = selector.select(timeout=1.0)
+      now = time.monotonic()
+      for key, _ in events:
+        sock = key.fileobj
+        if sock is self._wake_r:
+          try:
+            while self._wake_r.recv(4096):
+              pass
+          except BlockingIOError:
+            pass
+          continue
+        selector.unregister(sock)
+        address, _ = idle.pop(sock)
+        with self._lock:
+          self._busy += 1
+        self._pool.submit(self._process_request_worker, sock, address)
+      with self._lock:
+        incoming, self._incoming = self._incoming, deque()
+        busy = self._busy
+      for sock, address in incoming:
+        while idle and len(idle) + busy >= self.max_connections:
+          old, _ = idle.popitem(last=False)
+          selector.unregister(old)
+          self.shutdown_request(old)
+        if len(idle) + busy >= self.max_connections:
+          # Every slot is busy serving a request: refuse rather than queue without bound.
+          self.shutdown_request(sock)
+          continue
+        try:
+          selector.register(sock, selectors.EVENT_READ)
+        except (OSError, ValueError):
+          self.shutdown_request(sock)
+          continue
+        idle[sock] = (address, now)
+      while idle:
+        sock, (_, since) = next(iter(idle.items()))
+        if now - since < KEEPALIVE_TIMEOUT_S:
+          break
+        del idle[sock]
+        selector.unregister(sock)
+        self.shutdown_request(sock)
+
+  def _process_request_worker(self, request: Any, client_address: Any) -> None:
+    parked = False
+    try:
+      handler = self.RequestHandlerClass(request, client_address, self)
+      parked = getattr(handler, "parked", False)
+    except Exception:
+      self.handle_error(request, client_address)
+    finally:
+      with self._lock:
+        self._busy -= 1
+      if parked:
+        self._hand_over(request, client_address)
+      else:
+        self.shutdown_request(request)
+
+  def server_close(self) -> None:
+    super().server_close()
+    self._pool.shutdown(wait=False, cancel_futures=True)
+
+
 class Handler(BaseHTTPRequestHandler):
   server_version = "TikTokParodyPy/1.0"
+  protocol_version = "HTTP/1.1"
+  # Applied to the socket by StreamRequestHandler while a request is being read.
+  timeout = REQUEST_TIMEOUT_S
+  # Headers and body go out in separate writes; without TCP_NODELAY a reused connection stalls on delayed ACKs.
+  disable_nagle_algorithm = True
 
   def log_message(self, fmt: str, *args: Any) -> None:
     # Keep logs readable.
     super().log_message("%s - %s" % (self.address_string(), fmt), *args)
 
+  def handle(self) -> None:
+    # Serve requests that are already waiting (pipelining); then give the worker back and let the server park
+    # the connection until the client sends again. Parking is only safe with nothing left in our read buffer.
+    self.parked = False
+    self.close_connection = True
+    self.handle_one_request()
+    while not self.close_connection:
+      if not self._pending():
+        self.parked = True
+        return
+      self.handle_one_request()
+
+  def _pending(self) -> bool:
+    self.connection.settimeout(0)
+    try:
+      return bool(self.rfile.peek(1))
+    except OSError:
+      return False
+    finally:
+      self.connection.settimeout(self.timeout)
+
+  def parse_request(self) -> bool:
+    self._body_read = False
+    return super().parse_request()
+
+  def _read_body(self) -> bytes:
+    # Always consume the declared body, even when we don't need it, so the next pipelined request starts at the
+    # right byte on a keep-alive connection.
+    try:
+      length = int(self.headers.get("Content-Length") or "0")
+    except Exception:
+      length = -1
+    if length < 0 or self.headers.get("Transfer-Encoding"):
+      # We don't speak chunked request bodies; without a usable length the stream can't be re-synced.
+      self.close_connection = True
+      return b""
+    body = self.rfile.read(length) if length > 0 else b""
+    self._body_read = True
+    return body
+
+  def send_error(self, code: int, message: str | None = None, explain: str | None = None) -> None:
+    # The stock send_error always answers with "Connection: close". When the request was fully read (routing
+    # errors like 404/403) the connection is still in sync, so send a sized body and keep it alive instead.
+    if not getattr(self, "_body_read", False) or self.close_connection:
+      super().send_error(code, message, explain)
+      return
+    try:
+      shortmsg, longmsg = self.responses[code]
+    except KeyError:
+      shortmsg, longmsg = "???", "???"
+    message = shortmsg if message is None else message
+    explain = longmsg if explain is None else explain
+    self.log_error("code %d, message %s", code, message)
+    body = (self.error_message_format % {
+      "code": code,
+      "message": html.escape(message, quote=False),
+      "explain": html.escape(explain, quote=False),
+    }).encode("utf-8", "replace")
+    self._send_bytes(body, self.error_content_type, code)
+
   def _send_json(self, data: Any, status: int = 200) -> None:
-    raw = json.dumps(data, ensure_ascii=False).encode("utf-8")
-    self.send_response(status)
-    self.send_header("Content-Type", "application/json; charset=utf-8")
-    self.send_header("Content-Length", str(len(raw)))
-    self.send_header("Cache-Control", "no-store")
-    self.end_headers()
-    self.wfile.write(raw)
+    raw = jsonenc.dumpb(data)
+    self._send_bytes(raw, "application/json; charset=utf-8", status)
 
   def _send_bytes(self, b: bytes, ctype: str, status: int = 200, cache: str = "no-store") -> None:
     self.send_response(status)
     self.send_header("Content-Type", ctype)
     self.send_header("Content-Length", str(len(b)))
     self.send_header("Cache-Control", cache)
+    if self.close_connection:
+      self.send_header("Connection", "close")
+    else:
+      self.send_header("Keep-Alive", f"timeout={KEEPALIVE_TIMEOUT_S}")
     self.end_headers()
-    self.wfile.write(b)
+    if self.command != "HEAD":
+      self.wfile.write(b)
 
   def _serve_file(self, path: Path) -> None:
     if not path.exists() or not path.is_file():
@@ -154,6 +378,7 @@ class Handler(BaseHTTPRequestHandler):
     self._send_bytes(data, _content_type(path.name), 200, cache=cache)
 
   def do_GET(self) -> None:
+    self._read_body()
     parsed = urlparse(self.path)
     path = parsed.path
 
@@ -163,25 +388,33 @@ class Handler(BaseHTTPRequestHandler):
 
     if path.startswith("/api/"):
       if path == "/api/feed":
-        # Merge persistent likes into the feed.
-        likes_overrides = STATE.get("likes", {})
-        out = []
-        for item in FEED:
-          it = dict(item)
-          st = dict(it.get("stats", {}))
-          lid = it.get("id", "")
-          if isinstance(likes_overrides, dict) and lid in likes_overrides:
-            try:
-              st["likes"] = int(likes_overrides[lid])
-            except Exception:
-              pass
-          it["stats"] = st
-          out.append(it)
-        self._send_json({"items": out, "server_time_ms": _now_ms()})
+        # Merge persistent likes into the pre-encoded clips.
+        items = b",".join(clip.encode(_likes(clip.id)) for clip in CATALOG.snapshot().clips)
+        raw = b'{"items":[' + items + b'],"server_time_ms":' + str(_now_ms()).encode("ascii") + b"}"
+        self._send_bytes(raw, "application/json; charset=utf-8")
+        return
+
+      if path == "/api/search":
+        qs = parse_qs(parsed.query)
+        try:
+          limit = max(1, min(100, int(qs.get("limit", ["20"])[0])))
+          offset = max(0, int(qs.get("offset", ["0"])[0]))
+        except ValueError:
+          self._send_json({"error": "Bad limit/offset"}, status=400)
+          return
+        snap = CATALOG.snapshot()
+        total, ids = _search_index(snap).search(qs.get("q", [""])[0], limit=limit, offset=offset)
+        clips = [snap.by_id[i] for i in ids if i in snap.by_id]
+        items = b",".join(clip.encode(_likes(clip.id)) for clip in clips)
+        raw = (
+          b'{"items":[' + items + b'],"total":' + str(total).encode("ascii")
+          + b',"server_time_ms":' + str(_now_ms()).encode("ascii") + b"}"
+        )
+        self._send_bytes(raw, "application/json; charset=utf-8")
         return
 
       if path == "/api/state":
-        self._send_json({"updated_ms": STATE.get("updated_ms", _now_ms())})
+        self._send_json({"updated_ms": REPLICA.updated_ms if REPLICA is not None else COUNTERS.updated_ms})
         return
 
       self._send_json({"error": "Unknown endpoint"}, status=404)
@@ -199,17 +432,13 @@ class Handler(BaseHTTPRequestHandler):
     self._serve_file(file_path)
 
   def do_POST(self) -> None:
+    body = self._read_body() or b"{}"
     parsed = urlparse(self.path)
     path = parsed.path
 
     if path == "/api/like":
       try:
-        length = int(self.headers.get("Content-Length") or "0")
-      except Exception:
-        length = 0
-      body = self.rfile.read(length) if length > 0 else b"{}"
-      try:
-        payload = json.loads(body.decode("utf-8"))
+        payload = jsonenc.loads(body)
       except Exception:
         payload = {}
 
@@ -220,32 +449,75 @@ class Handler(BaseHTTPRequestHandler):
       except Exception:
         delta_i = 1
 
-      ids = {x.get("id") for x in FEED}
-      if clip_id not in ids:
+      if CATALOG.get(clip_id) is None:
         self._send_json({"error": "Unknown id"}, status=404)
         return
 
-      likes = STATE.setdefault("likes", {})
-      try:
-        cur = int(likes.get(clip_id, 0))
-      except Exception:
-        cur = 0
-      nxt = max(0, cur + delta_i)
-      likes[clip_id] = nxt
-      _save_state(STATE)
+      nxt = REPLICA.add(clip_id, delta_i) if REPLICA is not None else COUNTERS.add(clip_id, delta_i)
       self._send_json({"id": clip_id, "likes": nxt})
       return
 
+    if path == SYNC_PATH:
+      if REPLICA is None:
+        self._send_json({"error": "Replication is off"}, status=404)
+        return
+      try:
+        vv = read_vv(jsonenc.loads(body))
+      except ValueError as e:
+        self._send_json({"error": str(e)}, status=400)
+        return
+      self._send_bytes(jsonenc.dumpb(REPLICA.delta_for(vv)), "application/json; charset=utf-8")
+      return
+
     self._send_json({"error": "Unknown endpoint"}, status=404)
 
 
 def main() -> None:
-  host = "127.0.0.1"
-  port = 8008
-  httpd = ThreadingHTTPServer((host, port), Handler)
-  print(f"TikTok parody running: http://{host}:{port}")
+  global CATALOG, COUNTERS, DATA, STATE_PATH, COUNTERS_PATH, REPLICA
+  parser = argparse.ArgumentParser(description="TikTok parody server")
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=8008)
+  parser.add_argument("--processes", type=int, default=1, help="worker processes sharing the listening socket")
+  parser.add_argument("--catalog", type=Path, default=CATALOG_PATH, help="clip catalog JSON, reloaded on change")
+  parser.add_argument("--data", type=Path, default=DATA, help="state directory (likes, checkpoints, replica files)")
+  parser.add_argument("--node", help="replication node id; likes are kept in <data>/replica-<node>.json")
+  parser.add_argument("--peers", default="", help="comma-separated base URLs of the other nodes")
+  args = parser.parse_args()
+  if args.node and args.processes > 1:
+    # The replica is in-process state; forked workers would each diverge with the same node id.
+    parser.error("--node needs --processes 1")
+
+  if args.catalog != CATALOG_PATH:
+    CATALOG = Catalog(args.catalog)
+  DATA = args.data.resolve()
+  STATE_PATH = DATA / STATE_PATH.name
+  COUNTERS_PATH = DATA / COUNTERS_PATH.name
+  COUNTERS = _open_counters()
+  if args.node:
+    REPLICA = Replica(args.node, DATA / f"replica-{args.node}.json", parse_peers(args.peers))
+    if REPLICA.created:
+      # First start of this node: its current likes become its own share of the counters.
+      for clip_id, likes in COUNTERS.snapshot().items():
+        REPLICA.add(clip_id, likes)
+    REPLICA.start()
+
+  httpd = PooledHTTPServer((args.host, args.port), Handler)
+  print(f"TikTok parody running: http://{args.host}:{args.port}")
   print(f"Serving web from: {WEB}")
-  httpd.serve_forever()
+  # Workers are forked after bind so they all accept() on the same socket; the counter file is already
+  # mapped and shared.
+  for _ in range(max(1, args.processes) - 1):
+    if os.fork() == 0:
+      break
+  threading.Thread(target=_checkpoint_loop, name="checkpoint", daemon=True).start()
+  try:
+    httpd.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    _checkpoint()
+    if REPLICA is not None:
+      REPLICA.close()
 
 
 if __name__ == "__main__":
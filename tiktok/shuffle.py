@@ -0,0 +1,52 @@
+from __future__ import annotations
+
+import hashlib
+
+
+ROUNDS = 4
+CYCLE_BITS = 32
+
+
+def _domain_bits(size: int) -> int:
+    # Balanced Feistel needs an even bit width; keep at least 2 bits so tiny feeds still shuffle.
+    bits = max(2, (max(size, 1) - 1).bit_length())
+    return bits + (bits & 1)
+
+
+def _round_value(seed: bytes, rnd: int, half: int, half_bits: int) -> int:
+    digest = hashlib.blake2b(half.to_bytes(8, "little"), digest_size=8, key=seed, person=rnd.to_bytes(2, "little")).digest()
+    return int.from_bytes(digest, "little") & ((1 << half_bits) - 1)
+
+
+def _cycle_seed(user_id: int, cycle: int) -> bytes:
+    return hashlib.blake2b(f"{user_id}:{cycle}".encode("ascii"), digest_size=16).digest()
+
+
+def permute(x: int, bits: int, seed: bytes) -> int:
+    """Bijective map of [0, 2**bits) onto itself (4-round balanced Feistel network keyed by seed)."""
+    half_bits = bits // 2
+    mask = (1 << half_bits) - 1
+    left, right = x >> half_bits, x & mask
+    for rnd in range(ROUNDS):
+        left, right = right, left ^ _round_value(seed, rnd, right, half_bits)
+    return (left << half_bits) | right
+
+
+def shuffled_position(cursor: int, size: int, user_id: int) -> tuple[int, int]:
+    """Walk a per-user pseudorandom order over [0, size) and return (position, next cursor).
+
+    The cursor packs (cycle << CYCLE_BITS) | step. Each cycle is a fresh permutation of a power-of-two
+    domain covering `size`; steps that land past `size` are skipped (cycle walking), so within one cycle
+    no position repeats. Growing `size` inside the same domain just makes new positions reachable.
+    """
+    bits = _domain_bits(size)
+    cycle, step = cursor >> CYCLE_BITS, cursor & ((1 << CYCLE_BITS) - 1)
+    seed = _cycle_seed(user_id, cycle)
+    while True:
+        if step >= 1 << bits:
+            cycle, step = cycle + 1, 0
+            seed = _cycle_seed(user_id, cycle)
+        pos = permute(step, bits, seed)
+        step += 1
+        if pos < size:
+            return pos, (cycle << CYCLE_BITS) | step
@@ -0,0 +1,253 @@
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any
+
+import jsonenc
+
+
+# Standalone on purpose (no Flask/telegram imports), so backups work from any venv.
+# Paths mirror bot.py, app.py and server.py. "data/..." paths live in the state directory (--data, as in
+# app.py and server.py); each state directory keeps its own snapshots/.
+ROOT = Path(__file__).resolve().parent
+DATA_DIR = ROOT / "data"
+SNAPSHOTS_DIR = DATA_DIR / "snapshots"
+
+SQLITE_FILES = ["data/bot_db.sqlite3", "data/bot_nav.sqlite3"]
+JSON_FILES = ["data/db.json", "catalog.json"]
+STATE_FILE = "data/state.json"
+COUNTERS_FILE = "data/likes.counters"
+ARCHIVE_DIR = "data/archive"
+# Replication state (replica.py): a JSON file plus an append-only log replayed on top of it.
+REPLICA_GLOB = "replica-*"
+
+BACKUP_PAGES = 256
+BACKUP_SLEEP_S = 0.005
+MANIFEST = "MANIFEST.json"
+
+
+def _live(rel: str, data: Path) -> Path:
+    """Where snapshot path `rel` lives in the running tree."""
+    return data / rel[len("data/"):] if rel.startswith("data/") else ROOT / rel
+
+
+def _digest(path: Path) -> str:
+    h = hashlib.sha256()
+    with path.open("rb") as fh:
+        while chunk := fh.read(1024 * 1024):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _backup_sqlite(src: Path, dst: Path) -> None:
+    # Online backup API in small steps: between steps the source is unlocked, so writers keep going.
+    source = sqlite3.connect(f"file:{src}?mode=ro", uri=True)
+    target = sqlite3.connect(dst)
+    try:
+        source.backup(target, pages=BACKUP_PAGES, sleep=BACKUP_SLEEP_S)
+        # The copy inherits WAL mode, and opening a WAL database creates -wal/-shm files next to it. A
+        # rollback-journal copy is self-contained; bot.py and navstate.py switch it back to WAL after a restore.
+        target.execute("PRAGMA journal_mode=DELETE")
+    finally:
+        target.close()
+        source.close()
+
+
+def _copy_json(src: Path, dst: Path) -> None:
+    # Writers replace these files atomically (tmp + rename), so one read sees one whole version.
+    data = src.read_bytes()
+    jsonenc.loads(data)
+    dst.write_bytes(data)
+
+
+def _snapshot_likes(dst: Path, data: Path) -> bool:
+    """Write server.py likes as a state.json checkpoint taken from the live counter file.
+
+    The counter file is only read (never opened for writing); if it doesn't validate, the last
+    state.json checkpoint is copied instead.
+    """
+    from counters import read_snapshot
+
+    snap = read_snapshot(_live(COUNTERS_FILE, data))
+    if snap is not None:
+        likes, updated_ms = snap
+        dst.write_bytes(jsonenc.dumpb({"likes": likes, "updated_ms": updated_ms}))
+        return True
+    src = _live(STATE_FILE, data)
+    if src.exists():
+        _copy_json(src, dst)
+        return True
+    return False
+
+
+def _latest(base: Path) -> Path | None:
+    snaps = sorted(p for p in base.iterdir() if p.is_dir() and (p / MANIFEST).exists()) if base.exists() else []
+    return snaps[-1] if snaps else None
+
+
+def _resolve(name: Path, base: Path = SNAPSHOTS_DIR) -> Path:
+    return name if name.exists() or name.is_absolute() else base / name
+
+
+def create(base: Path = SNAPSHOTS_DIR, data: Path = DATA_DIR) -> Path:
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    final = base / stamp
+    n = 1
+    while final.exists():
+        final = base / f"{stamp}-{n}"
+        n += 1
+    work = base / f".{final.name}.partial"
+    shutil.rmtree(work, ignore_errors=True)
+    work.mkdir(parents=True)
+    previous = _latest(base)
+    files: dict[str, dict[str, Any]] = {}
+
+    def record(rel: str, kind: str) -> None:
+        path = work / rel
+        files[rel] = {"kind": kind, "size": path.stat().st_size, "sha256": _digest(path)}
+
+    for rel in SQLITE_FILES:
+        if _live(rel, data).exists():
+            (work / rel).parent.mkdir(parents=True, exist_ok=True)
+            _backup_sqlite(_live(rel, data), work / rel)
+            record(rel, "sqlite")
+    for rel in JSON_FILES:
+        if _live(rel, data).exists():
+            (work / rel).parent.mkdir(parents=True, exist_ok=True)
+            _copy_json(_live(rel, data), work / rel)
+            record(rel, "json")
+    (work / STATE_FILE).parent.mkdir(parents=True, exist_ok=True)
+    if _snapshot_likes(work / STATE_FILE, data):
+        record(STATE_FILE, "json")
+    # Log before JSON: compaction folds the log into the JSON, so this order never misses an entry.
+    for log in sorted(data.glob(REPLICA_GLOB + ".log")):
+        rel = f"data/{log.name}"
+        shutil.copyfile(log, work / rel)
+        record(rel, "log")
+    for state in sorted(data.glob(REPLICA_GLOB + ".json")):
+        rel = f"data/{state.name}"
+        _copy_json(state, work / rel)
+        record(rel, "json")
+
+    # Archive segments never change once written: hard-link them from the previous snapshot when possible.
+    archive_dir = _live(ARCHIVE_DIR, data)
+    for src in sorted(archive_dir.rglob("*.jsonl.gz")) if archive_dir.exists() else []:
+        rel = f"{ARCHIVE_DIR}/{src.relative_to(archive_dir).as_posix()}"
+        dst = work / rel
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        old = previous / rel if previous else None
+        try:
+            if old is None or not old.exists() or old.stat().st_size != src.stat().st_size:
+                raise FileNotFoundError
+            os.link(old, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+        record(rel, "segment")
+
+    manifest = {"created": stamp, "files": files}
+    (work / MANIFEST).write_text(json.dumps(manifest, indent=2) + "\n", encoding="utf-8")
+    os.replace(work, final)
+    return final
+
+
+def verify(snap: Path) -> list[str]:
+    """Return a list of problems (empty when the snapshot is intact)."""
+    problems: list[str] = []
+    try:
+        manifest = json.loads((snap / MANIFEST).read_text(encoding="utf-8"))
+    except Exception as e:
+        return [f"{MANIFEST}: unreadable ({e!r})"]
+    for rel, meta in manifest.get("files", {}).items():
+        path = snap / rel
+        if not path.exists():
+            problems.append(f"{rel}: missing")
+            continue
+        if path.stat().st_size != meta.get("size") or _digest(path) != meta.get("sha256"):
+            problems.append(f"{rel}: checksum mismatch")
+            continue
+        if meta.get("kind") == "sqlite":
+            # immutable=1: no locks and no -wal/-shm files, so checking never writes into the snapshot.
+            conn = sqlite3.connect(f"file:{path}?mode=ro&immutable=1", uri=True)
+            try:
+                (result,) = conn.execute("PRAGMA integrity_check").fetchone()
+            finally:
+                conn.close()
+            if result != "ok":
+                problems.append(f"{rel}: integrity_check: {result}")
+        elif meta.get("kind") == "json":
+            try:
+                jsonenc.loads(path.read_bytes())
+            except ValueError as e:
+                problems.append(f"{rel}: invalid JSON ({e})")
+    return problems
+
+
+def restore(snap: Path, data: Path = DATA_DIR) -> None:
+    """Put a verified snapshot back in place. Stop the bot and the web servers first."""
+    problems = verify(snap)
+    if problems:
+        raise SystemExit("refusing to restore, snapshot is damaged:\n  " + "\n  ".join(problems))
+    manifest = json.loads((snap / MANIFEST).read_text(encoding="utf-8"))
+    for rel, meta in manifest["files"].items():
+        target = _live(rel, data)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp = target.with_name(target.name + ".restore")
+        shutil.copyfile(snap / rel, tmp)
+        if meta["kind"] == "sqlite":
+            # A leftover WAL from the old database would be replayed on top of the restored one.
+            for suffix in ("-wal", "-shm"):
+                Path(str(target) + suffix).unlink(missing_ok=True)
+        os.replace(tmp, target)
+    if STATE_FILE in manifest["files"]:
+        # server.py rebuilds its live counters from state.json when the counter file is missing.
+        _live(COUNTERS_FILE, data).unlink(missing_ok=True)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Online snapshots of the bot and web state.")
+    parser.add_argument("--data", type=Path, default=DATA_DIR, help="state directory, as given to app.py/server.py")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("create", help="take a snapshot while services keep running")
+    sub.add_parser("list", help="list snapshots")
+    p_verify = sub.add_parser("verify", help="check checksums and database integrity")
+    p_verify.add_argument("snapshot", nargs="?", type=Path, help="snapshot dir (default: latest)")
+    p_restore = sub.add_parser("restore", help="restore a snapshot (services must be stopped)")
+    p_restore.add_argument("snapshot", type=Path)
+    args = parser.parse_args()
+    data = args.data.resolve()
+    base = data / SNAPSHOTS_DIR.name
+
+    if args.cmd == "create":
+        started = time.monotonic()
+        snap = create(base, data)
+        print(f"snapshot {snap} ({time.monotonic() - started:.2f}s)")
+    elif args.cmd == "list":
+        for p in sorted(base.iterdir()) if base.exists() else []:
+            if (p / MANIFEST).exists():
+                print(p.name)
+    elif args.cmd == "verify":
+        snap = _resolve(args.snapshot, base) if args.snapshot else _latest(base)
+        if snap is None:
+            raise SystemExit("no snapshots")
+        problems = verify(snap)
+        for problem in problems:
+            print(problem, file=sys.stderr)
+        print(f"{snap}: {'OK' if not problems else 'DAMAGED'}")
+        if problems:
+            raise SystemExit(1)
+    else:
+        restore(_resolve(args.snapshot, base), data)
+        print(f"restored {args.snapshot}")
+
+
+if __name__ == "__main__":
+    main()